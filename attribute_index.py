@@ -0,0 +1,86 @@
+# --------------------------------------------------------------------------------------
+# About: This file provides an inverted attribute index over integer-encoded users,
+#        used to answer match_count nearest-neighbor queries without scoring
+#        and sorting every user.
+# --------------------------------------------------------------------------------------
+
+import numpy as np
+
+# This class keeps a posting list of row indices for each (attribute position, level)
+# of an encoded user matrix (see util.LevelEncoder). A query's match counts are the
+# sum of the posting lists of its own attribute values, and since match counts are
+# integers in [0, number of attributes], the top k rows are read out of the highest
+# count buckets without a full sort.
+class AttributeIndex(object):
+	def __init__(self, codes):
+		self.size, self.width = codes.shape
+		self.postings = [] # postings[j][c] is the ascending array of rows with code c at position j
+		for j in range(self.width):
+			col = codes[:, j]
+			order = np.argsort(col, kind = 'mergesort')
+			bounds = np.searchsorted(col[order], np.arange(col.max() + 2 if self.size > 0 else 1))
+			self.postings.append(map(lambda c: order[bounds[c]:bounds[c + 1]], range(len(bounds) - 1)))
+	
+	# Returns a numpy array holding the match count of the encoded query against each row.
+	def match_counts(self, query):
+		counts = np.zeros(self.size, dtype = np.int16)
+		for (plist, c) in zip(self.postings, query):
+			if 0 <= c < len(plist):
+				counts[plist[c]] += 1
+		return counts
+	
+	# Returns (row indices, match counts) for the k rows with the highest match counts
+	# against the encoded query, highest first. Rows with equal counts come in row order.
+	def top_k(self, query, k):
+		counts = self.match_counts(query)
+		sizes = np.bincount(counts, minlength = self.width + 1)
+		buckets = []
+		taken = 0
+		for s in range(len(sizes) - 1, -1, -1):
+			if taken >= k:
+				break
+			if sizes[s] > 0:
+				bucket = np.flatnonzero(counts == s)[:k - taken]
+				buckets.append(bucket)
+				taken += len(bucket)
+		inds = np.concatenate(buckets) if len(buckets) > 0 else np.zeros(0, dtype = np.int64)
+		return (inds, counts[inds])
+	
+	# Add the rows of an encoded user matrix to the index, numbered on from the current rows.
+	def append(self, codes):
+		for j in range(self.width):
+			col = codes[:, j]
+			plist = self.postings[j]
+			for c in np.unique(col):
+				while len(plist) <= c:
+					plist.append(np.zeros(0, dtype = np.int64))
+				plist[c] = np.concatenate((plist[c], self.size + np.flatnonzero(col == c)))
+		self.size += len(codes)
+	
+	# Remove the rows at the given indices. Remaining rows are renumbered in order.
+	def remove(self, inds):
+		inds = np.unique(inds)
+		for plist in self.postings:
+			for c in range(len(plist)):
+				kept = plist[c][~np.in1d(plist[c], inds)]
+				plist[c] = kept - np.searchsorted(inds, kept)
+		self.size -= len(inds)
+	
+	# Returns (rows, bounds), from which restore rebuilds the index: rows[j] holds the
+	# posting lists of position j one after another, and bounds[j][c] is where list c starts.
+	def arrays(self):
+		rows = np.zeros((self.width, self.size), dtype = np.int64)
+		bounds = []
+		for (j, plist) in enumerate(self.postings):
+			sizes = map(len, plist)
+			bounds.append(np.concatenate(([0], np.cumsum(sizes))).astype(np.int64))
+			if len(plist) > 0:
+				rows[j] = np.concatenate(plist)
+		return (rows, bounds)
+	
+	# Replace the index with the one held in (rows, bounds), as returned by arrays. 
+	# The posting lists are views into rows, which may be a memory mapped array.
+	def restore(self, rows, bounds):
+		self.width, self.size = rows.shape
+		self.postings = map(lambda (r, b): map(lambda c: r[b[c]:b[c + 1]], range(len(b) - 1)), zip(rows, bounds))
+		return self
@@ -0,0 +1,53 @@
+# --------------------------------------------------------------------------------------
+# About: This file times the performance-critical building blocks used by the
+#        optimizer and scenarios. Usage: python benchmarks.py [top_n]
+# --------------------------------------------------------------------------------------
+
+from os import sys
+import time
+import numpy as np
+import util as ut
+
+# Returns the time in seconds taken by one call of f().
+def timed(f):
+	start = time.time()
+	f()
+	return time.time() - start
+
+# The original insertion-based top_n, kept as the baseline to compare against (and as
+# the reference the tests check top_n against).
+def insertion_top_n(items, n, accessor_f = lambda x: x):
+	top = []
+	for item in items:
+		if len(top) == 0 and n > 0:
+			top.append(item)
+		else:
+			i = 0
+			while i < len(top) and accessor_f(item) > accessor_f(top[i]):
+				i += 1
+			top.insert(i, item)
+			if len(top) > n:
+				del(top[0])
+	top.reverse()
+	return top
+
+# Times top-k selection of k neighbors out of n (user, similarity) pairs, as done 
+# in KNNOptimizer.knn, for the insertion baseline, the heap, and the partition.
+def bench_top_n(sizes = [5000, 50000, 1000000], k = 15, num_atts = 10):
+	print('top_n: selecting k = ' + str(k) + ' of n match counts')
+	print('n, insertion (s), heap (s), partition (s), speedup (heap), speedup (partition)')
+	for n in sizes:
+		sims = np.random.randint(0, num_atts + 1, n)
+		pairs = zip(range(n), sims.tolist())
+		t1 = timed(lambda: insertion_top_n(pairs, k, lambda (i, s): s))
+		t2 = timed(lambda: ut.top_n(pairs, k, lambda (i, s): s))
+		t3 = timed(lambda: ut.top_n_indices(sims, k))
+		print(', '.join(map(str, [n, round(t1, 4), round(t2, 4), round(t3, 4), 
+								  round(t1 / max(t2, 1e-6), 1), round(t1 / max(t3, 1e-6), 1)])))
+
+benchmarks = {'top_n': bench_top_n}
+
+if __name__ == '__main__':
+	names = sys.argv[1:] if len(sys.argv) > 1 else sorted(benchmarks.keys())
+	for name in names:
+		benchmarks[name]()
@@ -5,6 +5,7 @@
 # --------------------------------------------------------------------------------------
 
 import random as rd
+import numpy as np
 import util as ut
 
 class DataGenerator(object):
@@ -14,10 +15,12 @@ class DataGenerator(object):
 		self.inter_attrs = [] # A list of (name, [levels])
 		self.propensities = [] # A list of ([uatt1_val, uatt2_val,...iatt1_val, iatt2_val..], probability)
 		self.prevs = [] # A list of ([uatt1_val, uatt2_val...uattn_val], frequency)
+		self.matcher = None # Compiled form of self.propensities, built on first use
 	
 	# Set the baseline response probability.
 	def set_baseline_response_prob(self, prob):
 		self.baseline_response_prob = prob
+		self.matcher = None
 	
 	# An attribute has a name and list of levels.
 	def add_user_attr(self, name, levels):
@@ -56,6 +59,7 @@ class DataGenerator(object):
 					arr_pattern[i] = val
 			i += 1
 		self.propensities.append((arr_pattern, prob))
+		self.matcher = None
 	
 	# Set propensity for a specific user/inter pair.
 	def set_user_inter_propensity(self, user_template, inter_template, prob):
@@ -107,16 +111,32 @@ class DataGenerator(object):
 		self.prevs.append((arr_pattern, freq))
 		
 	# Returns 0 or 1 stochastically based on the user and interaction pattern.
+	# The response probability is that of the best matching propensity (as in
+	# ut.best_match), or the baseline if none match.
 	def gen_response(self, user, inter):
-		match = ut.best_match(user + inter, self.propensities, ignore=[None], patlist_accessor=lambda x: x[0])
-		if match != None:
-			(pat, prob) = match
-			return 1 if rd.uniform(0, 1) <= prob else 0
-		return 1 if rd.uniform(0, 1) <= self.baseline_response_prob else 0
+		return 1 if rd.uniform(0, 1) <= self.get_matcher().response_prob(user + inter) else 0
 	
-	# Generate responses for multiple user/interaction pairs.
+	# Generate responses for multiple user/interaction pairs. Propensities are 
+	# matched for all pairs at once and every outcome is drawn in one call to
+	# the numpy random generator.
 	def gen_responses(self, user_list, inter_list):
-		return map(lambda (x, y): self.gen_response(x, y), zip(user_list, inter_list))
+		probs = self.get_matcher().response_probs(user_list, inter_list)
+		return (np.random.uniform(0, 1, len(probs)) <= probs).astype(int).tolist()
+	
+	# As gen_responses, for users and interactions encoded as level indices (see 
+	# encode_entities). Returns a numpy array of 0/1 responses.
+	def gen_coded_responses(self, user_codes, inter_codes):
+		m = self.get_matcher()
+		probs = m.coded_probs(np.hstack((m.encode_side_levels(user_codes, self.user_attrs, True), 
+										 m.encode_side_levels(inter_codes, self.inter_attrs, False))))
+		return (np.random.uniform(0, 1, len(probs)) <= probs).astype(np.int8)
+	
+	# Returns the PropensityMatcher for the current propensities, compiling it if needed.
+	def get_matcher(self):
+		if self.matcher == None:
+			self.matcher = PropensityMatcher(self.propensities, len(self.user_attrs), 
+											 self.baseline_response_prob)
+		return self.matcher
 	
 	# A template is a dict of attribute/value pairs. Builds a random interaction
 	# from the template by randomly assigning values to unspecified attribute.
@@ -135,14 +155,14 @@ class DataGenerator(object):
 		return map(lambda x: self.gen_random_inter_from_template(template), range(n))
 	
 	# Returns a list of user attribute values in ordered array form.
-	# Each item in templates is a (dict, replicates) pair.
-	def gen_random_users(self, n, templates = []):
-		return self.gen_random_entities(self.user_attrs, n, templates)
+	# Each item in templates is a (dict, replicates) pair (see gen_random_entities).
+	def gen_random_users(self, n, templates = [], seed = None):
+		return self.gen_random_entities(self.user_attrs, n, templates, seed)
 	
 	# Returns a list of interaction attribute values in ordered array form.
-	# Each item in templates is a (dict, replicates) pair.
-	def gen_random_inters(self, n, templates = []):
-		return self.gen_random_entities(self.inter_attrs, n, templates)
+	# Each item in templates is a (dict, replicates) pair (see gen_random_entities).
+	def gen_random_inters(self, n, templates = [], seed = None):
+		return self.gen_random_entities(self.inter_attrs, n, templates, seed)
 	
 	# Returns list of (user patterns, inter patterns, resp), each in array form.
 	# Generates based on specified distributions.
@@ -163,6 +183,37 @@ class DataGenerator(object):
 		il = map(lambda x: rd.sample(inters, 1)[0], users)
 		return (ul, il, self.gen_responses(ul, il))
 	
+	# Yields the rows of gen_random_rows_from for n new random users, paired with random 
+	# interactions from inters, in blocks of at most block_size rows so that only one block
+	# is held at a time. Each block is a (user codes, interaction codes, responses) tuple of 
+	# numpy arrays, the codes being level indices (see encode_entities). The blocks can be
+	# split as they are generated (see ut.split_blocks).
+	def gen_row_blocks(self, n, inters, block_size = 10000):
+		inter_codes = self.encode_entities(inters, self.inter_attrs)
+		self.encode_entities([], self.user_attrs) # Checks that the user attributes are categorical
+		for start in range(0, n, block_size):
+			size = min(block_size, n - start)
+			user_codes = np.column_stack(self.sample_entity_columns(self.user_attrs, size)).astype(np.int32)
+			picks = inter_codes[np.random.randint(0, len(inters), size)]
+			yield (user_codes, picks, self.gen_coded_responses(user_codes, picks))
+	
+	# Encodes entities (lists of attribute values) as a numpy matrix holding the index
+	# of each value in its attribute's levels. attrs is a list of (name, [levels]), which
+	# must all be categorical.
+	def encode_entities(self, entities, attrs):
+		codes = np.empty((len(entities), len(attrs)), dtype = np.int32)
+		for (j, (name, levels)) in enumerate(attrs):
+			if type(levels) != type([]):
+				raise ValueError('Only categorical attributes can be encoded: ' + str(name))
+			h = dict(zip(levels, range(len(levels))))
+			codes[:, j] = np.fromiter((h[e[j]] for e in entities), np.int32, len(entities))
+		return codes
+	
+	# Decodes a matrix of level indices (see encode_entities) into a list of entities.
+	def decode_entities(self, codes, attrs):
+		cols = map(lambda (j, (name, levels)): np.array(levels, dtype = object)[codes[:, j]], enumerate(attrs))
+		return map(list, zip(*cols)) if len(cols) > 0 else map(lambda r: [], range(len(codes)))
+	
 	# For a set of users and inters, generate a set of rows from the cartesian product of these. 
 	# Returns list of (user patterns, inter patterns, resp), each in array form.
 	def gen_crossprod_rows(self, users, inters):
@@ -175,13 +226,30 @@ class DataGenerator(object):
 		responses = self.gen_responses(all_users, all_inters)
 		return (all_users, all_inters, responses)
 	
-	# Return the exhaustive list of unique user combinations.
+	# For a set of users and inters, simulate a response for every pair in their cartesian
+	# product and return a numpy array holding the number of positive responses for each
+	# interaction. Users are processed in chunks whose working arrays stay near max_bytes.
+	# Outcomes are drawn in the same order as gen_crossprod_rows, so for a given numpy 
+	# seed the counts match the responses it generates, whatever the chunk size.
+	def crossprod_success_counts(self, users, inters, max_bytes = 2**26):
+		matcher = self.get_matcher()
+		user_codes = matcher.encode_side(users, True)
+		inter_codes = matcher.encode_side(inters, False)
+		chunk_size = max(1, int(max_bytes / max(1, 17 * len(inters))))
+		counts = np.zeros(len(inters), dtype = np.int64)
+		for start in range(0, len(users), chunk_size):
+			probs = matcher.pair_probs(user_codes[start:start + chunk_size], inter_codes)
+			counts += (np.random.uniform(0, 1, probs.shape) <= probs).sum(axis = 0)
+		return counts
+	
+	# Return the exhaustive list of unique user combinations, as a lazy ut.MixedRadixSpace:
+	# combinations are made on indexing, slicing, or iterating (in chunks if large).
 	def unique_users(self):
-		return ut.cartesian_prod(map(lambda (n, levs): levs, self.user_attrs)) 
+		return ut.MixedRadixSpace(map(lambda (n, levs): levs, self.user_attrs)) 
 		
-	# Return the exhaustive list of unique interaction combinations.
+	# Return the exhaustive list of unique interaction combinations, as a lazy ut.MixedRadixSpace.
 	def unique_inters(self):
-		return ut.cartesian_prod(map(lambda (n, levs): levs, self.inter_attrs))
+		return ut.MixedRadixSpace(map(lambda (n, levs): levs, self.inter_attrs))
 	
 	# ------------------------ INTERNAL UTILITY FUNCTIONS ---------------------------------
 	def uatt_names(self):
@@ -222,28 +290,156 @@ class DataGenerator(object):
 				return False
 		return True
 	
-	# Each item in templates is a (dict, replicates) pair.
-	def gen_random_entities(self, attrs, n, templates = []):
+	# Each item in templates is a (dict, replicates) pair: replicates entities are made from
+	# each template, with its values and random others, and the remaining entities are 
+	# random ones matching no template. Entities are drawn a column at a time (see 
+	# sample_entity_columns) from a numpy RandomState with the given seed, or from the 
+	# global numpy generator if seed is None.
+	def gen_random_entities(self, attrs, n, templates = [], seed = None):
+		rs = np.random.RandomState(seed) if seed != None else np.random
 		rows = []
 		for (template, num_reps) in templates:
-			rows += map(lambda x: self.gen_random_entity_from_template(template, attrs), range(num_reps))
-		n = n - len(rows)
-		i = 0
-		nm = lambda e: len(filter(lambda x: x == True, map(lambda y: self.matches_template(y, attrs, e), map(lambda z: z[0], templates)))) == 0
-		while i < n:
-			curr = []
-			for (name, levels) in attrs:
-				if type(levels) == type([]):
-					curr.append(rd.sample(levels, 1)[0])
-				else:
-					curr.append(rd.uniform(levels[0], levels[1]))
-			if nm(curr):
-				rows.append(curr)
-				i += 1
-		return rows
-		
+			cols = self.entity_values(attrs, self.sample_entity_columns(attrs, num_reps, [], rs))
+			cols = map(lambda ((name, levels), col): [template[name]] * num_reps if template.has_key(name) else col, 
+					   zip(attrs, cols))
+			rows += self.zip_columns(cols, num_reps)
+		n = max(0, n - len(rows))
+		cols = self.sample_entity_columns(attrs, n, map(lambda (template, num_reps): template, templates), rs)
+		return rows + self.zip_columns(self.entity_values(attrs, cols), n)
 	
-		
+	# Draws n random entities over attrs, returned as a list of columns holding one numpy 
+	# array per attribute: level indices for categorical attributes, and values for 
+	# continuous (min, max) ones. Each column takes one call to the random generator rs.
+	# Entities matching any of the exclude templates are drawn again, only those rows 
+	# being redrawn, until none match.
+	def sample_entity_columns(self, attrs, n, exclude = [], rs = np.random):
+		draw = lambda (name, levels), m: rs.randint(0, len(levels), m) if type(levels) == type([]) \
+										 else rs.uniform(levels[0], levels[1], m)
+		cols = map(lambda att: draw(att, n), attrs)
+		redo = self.template_mask(cols, attrs, n, exclude)
+		while redo.any():
+			rows = np.flatnonzero(redo)
+			for (j, att) in enumerate(attrs):
+				cols[j][rows] = draw(att, len(rows))
+			redo[rows] = self.template_mask(map(lambda col: col[rows], cols), attrs, len(rows), exclude)
+		return cols
 	
-		
-	
\ No newline at end of file
+	# Returns a boolean numpy array marking which of the n entities, given as columns (as
+	# by sample_entity_columns), match any of the templates (as by matches_template).
+	def template_mask(self, cols, attrs, n, templates):
+		mask = np.zeros(n, dtype = bool)
+		for template in templates:
+			match = np.ones(n, dtype = bool)
+			for ((name, levels), col) in zip(attrs, cols):
+				if template.has_key(name) and type(levels) == type([]):
+					match &= (col == levels.index(template[name])) if template[name] in levels else False
+				elif template.has_key(name):
+					match &= col == template[name]
+			mask |= match
+		return mask
+	
+	# The attribute values of columns drawn by sample_entity_columns, as a list of lists.
+	def entity_values(self, attrs, cols):
+		return map(lambda ((name, levels), col): np.array(levels, dtype = object)[col].tolist() 
+					if type(levels) == type([]) else col.tolist(), zip(attrs, cols))
+	
+	# Joins n entities' value columns into a list of entities.
+	def zip_columns(self, cols, n):
+		return map(list, zip(*cols)) if len(cols) > 0 else map(lambda i: [], range(n))
+
+# This class compiles a list of propensities, each of form ([uatt1_val, ..iatt1_val, ..], prob)
+# with None for unspecified attributes, for fast matching against (user, interaction) 
+# pairs. Patterns are kept most specific first (ties in their original order), so the
+# first compatible pattern is the best match of ut.best_match. Pattern values are 
+# integer-coded per attribute position, and row values no pattern uses are coded -1.
+class PropensityMatcher(object):
+	def __init__(self, propensities, num_user_atts, baseline_prob):
+		self.num_user_atts = num_user_atts
+		self.baseline_prob = baseline_prob
+		specificity = lambda (pat, prob): len(filter(lambda v: v != None, pat))
+		ranked = sorted(propensities, key = specificity, reverse = True)
+		# For single rows: a list of ([(position, value)], prob), best first
+		self.patterns = map(lambda (pat, prob): (filter(lambda (j, v): v != None, enumerate(pat)), prob), ranked)
+		# For arrays of rows: value codes per position and the coded patterns
+		self.positions = sorted(set(reduce(lambda w, x: w + x, map(lambda (ps, prob): map(lambda (j, v): j, ps), self.patterns), [])))
+		self.value_codes = dict(map(lambda j: (j, {}), self.positions))
+		self.coded = []
+		for (ps, prob) in self.patterns:
+			coded = []
+			for (j, v) in ps:
+				if not(self.value_codes[j].has_key(v)):
+					self.value_codes[j][v] = len(self.value_codes[j])
+				coded.append((self.positions.index(j), self.value_codes[j][v]))
+			self.coded.append((coded, prob))
+	
+	# The response probability for one combined (user + interaction) row.
+	def response_prob(self, row):
+		for (ps, prob) in self.patterns:
+			if all(row[j] == v for (j, v) in ps):
+				return prob
+		return self.baseline_prob
+	
+	# Encodes the pattern positions held by users (if user is True) or by interactions
+	# into a matrix of shape (rows, pattern positions on that side).
+	def encode_side(self, rows, user):
+		offset = 0 if user else self.num_user_atts
+		cols = filter(lambda j: (j < self.num_user_atts) == user, self.positions)
+		codes = np.empty((len(rows), len(cols)), dtype = np.int32)
+		for (c, j) in enumerate(cols):
+			h = self.value_codes[j]
+			codes[:, c] = np.fromiter((h.get(r[j - offset], -1) for r in rows), np.int32, len(rows))
+		return codes
+	
+	# Encodes the pattern positions of (user, interaction) pairs into a matrix of 
+	# shape (pairs, pattern positions).
+	def encode(self, user_list, inter_list):
+		return np.hstack((self.encode_side(user_list, True), self.encode_side(inter_list, False)))
+	
+	# As encode_side, for rows given as a matrix of indices into the levels of attrs, 
+	# a list of (name, [levels]) (see DataGenerator.encode_entities).
+	def encode_side_levels(self, level_codes, attrs, user):
+		offset = 0 if user else self.num_user_atts
+		cols = filter(lambda j: (j < self.num_user_atts) == user, self.positions)
+		codes = np.empty((len(level_codes), len(cols)), dtype = np.int32)
+		for (c, j) in enumerate(cols):
+			h = self.value_codes[j]
+			lookup = np.array(map(lambda v: h.get(v, -1), attrs[j - offset][1]), dtype = np.int32)
+			codes[:, c] = lookup[level_codes[:, j - offset]]
+		return codes
+	
+	# Returns a numpy array of response probabilities for the (user, interaction) pairs.
+	def response_probs(self, user_list, inter_list):
+		return self.coded_probs(self.encode(user_list, inter_list))
+	
+	# Returns a numpy array of response probabilities for pairs encoded as by encode.
+	def coded_probs(self, codes):
+		probs = np.empty(len(codes))
+		probs.fill(self.baseline_prob)
+		unmatched = np.ones(len(codes), dtype = bool)
+		for (coded, prob) in self.coded:
+			match = unmatched.copy()
+			for (c, v) in coded:
+				match &= codes[:, c] == v
+			probs[match] = prob
+			unmatched &= ~match
+		return probs
+	
+	# Returns a (users X interactions) numpy array of response probabilities for every
+	# pairing of the encoded users and interactions (as given by encode_side).
+	def pair_probs(self, user_codes, inter_codes):
+		num_user_cols = user_codes.shape[1]
+		probs = np.empty((len(user_codes), len(inter_codes)))
+		probs.fill(self.baseline_prob)
+		unmatched = np.ones(probs.shape, dtype = bool)
+		for (coded, prob) in self.coded:
+			umatch = np.ones(len(user_codes), dtype = bool)
+			imatch = np.ones(len(inter_codes), dtype = bool)
+			for (c, v) in coded:
+				if c < num_user_cols:
+					umatch &= user_codes[:, c] == v
+				else:
+					imatch &= inter_codes[:, c - num_user_cols] == v
+			match = unmatched & umatch[:, np.newaxis] & imatch[np.newaxis, :]
+			probs[match] = prob
+			unmatched &= ~match
+		return probs
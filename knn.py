@@ -4,8 +4,20 @@
 #        interaction design algorithm.
 # --------------------------------------------------------------------------------------
 
+import os
+import cPickle
+import shutil
+import atexit
+import tempfile
+import multiprocessing
 import util as ut
 import random as rd
+from collections import OrderedDict
+import time
+import numpy as np
+from attribute_index import AttributeIndex
+from lsh import MinHashIndex
+from training_data import TrainingData
 
 # -------------------- UTIL FUNCTIONS/SIMILARITY MEASURES ---------
 
@@ -14,12 +26,98 @@ import random as rd
 def match_count(v1, v2):
 	return len(filter(lambda (x, y): x == y, zip(v1, v2)))
 	
+# -------------------- Similarity Kernels -------------------------
+# A similarity kernel computes similarities in bulk over the encoded training data,
+# instead of calling a similarity function once per pair of users. A kernel is a
+# function of form f: TrainingData X [users] X start X rows -> numpy array of shape 
+# (len(users), len(store) - start), holding the similarity of each user to each
+# stored user from index start on, or to the stored users at the given rows (an 
+# index array) if rows is not None. Kernels are built by name through 
+# build_similarity_kernel (see similarity_kernels below). A kernel that ranks 
+# users by match count carries an of_match_count function, mapping match counts
+# to its similarities, which lets an AttributeIndex answer its queries. Each kernel
+# also carries work_bytes, the most bytes it holds at once per similarity (its result
+# and temporaries), by which KNNOptimizer.optimize_many sizes its tiles.
+
+# The match count of each user against the stored users, accumulated one 
+# attribute at a time so no (users X data X attributes) array is allocated.
+def match_count_kernel(store, users, start = 0, rows = None):
+	q = store.user_encoder.encode(users)
+	data = store.users[start:] if rows is None else store.users[rows]
+	sims = np.zeros((len(users), len(data)), dtype = np.int16)
+	for j in range(q.shape[1]):
+		sims += q[:, j, np.newaxis] == data[np.newaxis, :, j]
+	return sims
+match_count_kernel.of_match_count = lambda counts, width: counts
+match_count_kernel.work_bytes = 3 # int16 similarities and a boolean comparison
+
+# Builds a weighted match kernel: the sum of weights[j] over the attribute 
+# positions j at which two users agree. By default every weight is 1.
+def build_weighted_match_kernel(weights = None):
+	def kernel(store, users, start = 0, rows = None):
+		q = store.user_encoder.encode(users)
+		data = store.users[start:] if rows is None else store.users[rows]
+		w = weights if weights is not None else map(lambda j: 1, range(q.shape[1]))
+		sims = np.zeros((len(users), len(data)))
+		for j in range(q.shape[1]):
+			sims += w[j] * (q[:, j, np.newaxis] == data[np.newaxis, :, j])
+		return sims
+	kernel.work_bytes = 17 # Float similarities, a boolean comparison, and its weighted floats
+	return kernel
+
+# The Jaccard similarity of two users seen as sets of (position, value) pairs.
+# Both sets have one pair per attribute, so with m matches out of w attributes
+# it is m / (2w - m), and users rank exactly as by match count.
+def jaccard_of_match_count(counts, width):
+	return counts / (2.0 * width - counts) if width > 0 else np.zeros(len(counts))
+
+def jaccard_kernel(store, users, start = 0, rows = None):
+	return jaccard_of_match_count(match_count_kernel(store, users, start, rows), store.user_encoder.width())
+jaccard_kernel.of_match_count = jaccard_of_match_count
+jaccard_kernel.work_bytes = 19 # int16 match counts, then a float denominator and result
+
+# True if every level is a number, in which case gower_kernel treats the attribute as numeric.
+def numeric_levels(levels):
+	return len(levels) > 0 and all(map(lambda v: type(v) in [int, long, float], levels))
+
+# Gower-style similarity for mixed attributes: the mean over attribute positions of 
+# 1 for a match and 0 otherwise on categorical attributes, and 1 - |x - y| / range 
+# (at least 0) on numeric ones, where range is that of the attribute's stored levels.
+def gower_kernel(store, users, start = 0, rows = None):
+	q = store.user_encoder.encode(users)
+	data = store.users[start:] if rows is None else store.users[rows]
+	sims = np.zeros((len(users), len(data)))
+	for (j, levels) in enumerate(store.user_encoder.levels):
+		if numeric_levels(levels):
+			vals = np.array(levels, dtype = float)
+			x = np.array(map(lambda u: u[j], users), dtype = float)
+			d = np.abs(x[:, np.newaxis] - vals[data[:, j]][np.newaxis, :])
+			spread = vals.max() - vals.min()
+			sims += (d == 0) if spread == 0 else np.maximum(0, 1 - d / spread)
+		else:
+			sims += q[:, j, np.newaxis] == data[np.newaxis, :, j]
+	return sims / max(1, store.user_encoder.width())
+gower_kernel.work_bytes = 40 # Float similarities and up to four float temporaries of a numeric attribute
+
+# The built-in kernels by name. Each entry builds the kernel from its arguments,
+# if any (e.g. the weights of weighted_match).
+similarity_kernels = {'match_count': lambda: match_count_kernel,
+					  'weighted_match': build_weighted_match_kernel,
+					  'jaccard': lambda: jaccard_kernel,
+					  'gower': lambda: gower_kernel}
+
+# Builds the named similarity kernel with the given arguments.
+def build_similarity_kernel(name, *args):
+	if not(similarity_kernels.has_key(name)):
+		raise ValueError('Unknown similarity kernel: ' + str(name))
+	return similarity_kernels[name](*args)
+	
 # Aggregates (attribute, similarity) tuples using specified weighting function.
 # Normalized att tuples are list in format [(att. value, similarity score)].
 # weight_f is function of form f: similarity -> R+
-# Returns: a dict of form {att_val: total_weight}
+# Returns: a dict of form {att_val: total_weight}, ordered by first appearance
 def weighted_agg(normalized_att_tuples, weight_f = lambda s: 1):
-	h = {}
+	h = OrderedDict()
 	for (av, s) in normalized_att_tuples:
 		if not(h.has_key(av)):
 			h[av] = 0
@@ -29,12 +127,26 @@ def weighted_agg(normalized_att_tuples, weight_f = lambda s: 1):
 # -------------------- Attribute Selectors and Selector Builders -	
 # Each attribute selector takes a list of positive and negative 
 # normalized attribute values and returns a single attribute value.
-# An attribute selector builder constructs such a function.
+# An attribute selector builder constructs such a function. Ties go to
+# the value that appears first among the normalized attribute values.
+# The builders also attach the selector's weight_f and a tally class 
+# (see below), which let KNNOptimizer.optimize_k_range evaluate the 
+# selector for every k of a sweep in one pass, and a selector kernel
+# (see below), which lets KNNOptimizer select on the encoded messages.
 
 # Builds a weighted mode selector on the positive attributes only, 
 # using the specified weighting function. 
 def build_weighted_mode_selector(weight_f = lambda x: 1):
-	return lambda pos, neg: ut.top_n(weighted_agg(pos, weight_f).items(), 1, lambda (a, v): v)[0][0]	
+	select = lambda pos, neg: ut.top_n(weighted_agg(pos, weight_f).items(), 1, lambda (a, v): v)[0][0]	
+	select.weight_f = weight_f
+	select.tally = WeightedModeTally
+	select.kernel = weighted_mode_kernel
+	return select
+
+# The positive proportion of an attribute value, given its total positive
+# weight and a dict of negative weights.
+def pos_proportion(av, pos_weight, nv):
+	return float(pos_weight) / (float(pos_weight) + float(nv[av])) if nv.has_key(av) else 1.0
 
 # Builds a weighted maximum positive proportion selector, 
 # using the specified weighting function. 
@@ -42,90 +154,707 @@ def build_weighted_max_pos_proportion_selector(weight_f = lambda x: 1):
 	def wps(pos, neg):
 		pv = weighted_agg(pos, weight_f)
 		nv = weighted_agg(neg, weight_f)
-		f = lambda key: float(pv[key]) / float(pv[key]) + float(nv[key]) if key in nv.keys() else 1.0
-		return map(lambda x: (x, f(x)), pv.keys())
-	return lambda p, n: ut.top_n(wps(p, n), 1, lambda (a, v): v)[0]
+		return map(lambda (av, w): (av, pos_proportion(av, w, nv)), pv.items())
+	select = lambda p, n: ut.top_n(wps(p, n), 1, lambda (a, v): v)[0][0]
+	select.weight_f = weight_f
+	select.tally = WeightedMaxPosProportionTally
+	select.kernel = weighted_max_pos_proportion_kernel
+	return select
+
+# -------------------- Selector Kernels ---------------------------
+# A selector kernel is the array form of a selector. It takes the level codes
+# of one message attribute in the positive messages and in the negative ones,
+# with the weight of each message (the weight_f of its user's similarity), and
+# returns the selected code. Totals per level come from a weighted bincount. As
+# with the selectors, ties go to the code appearing first in the positive codes.
+
+# The distinct codes, in order of first appearance.
+def first_appearance(codes):
+	ucodes, firsts = np.unique(codes, return_index = True)
+	return ucodes[np.argsort(firsts)]
+
+# Kernel of the weighted mode selector.
+def weighted_mode_kernel(pos, pos_weights, neg, neg_weights):
+	levels = first_appearance(pos)
+	return levels[np.argmax(np.bincount(pos, weights = pos_weights)[levels])]
+
+# Kernel of the weighted maximum positive proportion selector.
+def weighted_max_pos_proportion_kernel(pos, pos_weights, neg, neg_weights):
+	levels = first_appearance(pos)
+	size = max(pos.max(), neg.max() if len(neg) > 0 else 0) + 1
+	pv = np.bincount(pos, weights = pos_weights, minlength = size)[levels]
+	nv = np.bincount(neg, weights = neg_weights, minlength = size)[levels]
+	seen = np.bincount(neg, minlength = size)[levels] > 0
+	props = np.ones(len(levels))
+	props[seen] = pv[seen] / (pv[seen] + nv[seen])
+	return levels[np.argmax(props)]
+
+# -------------------- Incremental Selector Tallies ---------------
+# A tally holds the running weighted votes for one message attribute as
+# neighbors are added in similarity order, and reports the value its 
+# selector would choose from the votes added so far. Values are ranked
+# in order of their first positive vote, as in weighted_agg.
+
+# Tally for the weighted mode selector. Totals only grow, so the leading
+# value is maintained as votes arrive.
+class WeightedModeTally(object):
+	def __init__(self):
+		self.pv = {}
+		self.rank = {}
+		self.best = None
+	
+	def add(self, av, weight, positive):
+		if not(positive):
+			return
+		if not(self.pv.has_key(av)):
+			self.pv[av] = 0
+			self.rank[av] = len(self.rank)
+		self.pv[av] += weight
+		if self.best == None or self.pv[av] > self.pv[self.best] or \
+		   (self.pv[av] == self.pv[self.best] and self.rank[av] < self.rank[self.best]):
+			self.best = av
+	
+	def select(self):
+		return self.best
 
+# Tally for the weighted maximum positive proportion selector. Proportions
+# can fall as negative votes arrive, so they are compared on each select.
+class WeightedMaxPosProportionTally(object):
+	def __init__(self):
+		self.pv = OrderedDict()
+		self.nv = {}
+	
+	def add(self, av, weight, positive):
+		h = self.pv if positive else self.nv
+		if not(h.has_key(av)):
+			h[av] = 0
+		h[av] += weight
+	
+	def select(self):
+		props = map(lambda (av, w): (av, pos_proportion(av, w, self.nv)), self.pv.items())
+		return ut.top_n(props, 1, lambda (a, v): v)[0][0]
+
+	
+# -------------------- NEIGHBOR LISTS -----------------------------
+# The neighbors of one user, most similar first, searched to a given depth.
+# Neighbors are held as indices into the optimizer's TrainingData, so the
+# neighbors for any k up to the depth are served without searching again.
+# The messages designed from them are memoized here too, and so are dropped
+# along with the list when it is evicted or invalidated.
+class Neighbors(object):
+	def __init__(self, user, depth, inds, sims):
+		self.user = user # The user whose neighbors these are
+		self.depth = depth # The k this list was searched for
+		self.inds = inds # Data row indices of the neighbors
+		self.sims = sims # Similarities of the neighbors
+		self.designs = {} # {(k, selector): message, or None if the first k have no positive message}
+	
+	# True if the first k neighbors are known, either because k is within the
+	# searched depth or because every data row is already in the list.
+	def covers(self, k):
+		return k <= self.depth or len(self.inds) < self.depth
 	
 # -------------------- OPTIMIZER CLASS ----------------------------
+# The training data is held in a compact TrainingData store (see training_data.py),
+# with one entry per distinct user profile (see dedup_stats).
+# The neighbor cache may be bounded by number of users (cache_entries) and/or
+# estimated bytes (cache_bytes), in which case least recently used users are
+# evicted first. self.cache.stats() reports its hits, misses, and evictions.
 class KNNOptimizer(object):
-	def __init__(self):
-		self.data = [] # Aggregation of [(user, [pos msgs] [neg msgs]),..}
+	def __init__(self, cache_entries = None, cache_bytes = None):
+		self.store = TrainingData()
 		self.similarity_f = None
+		self.kernel = None # The similarity kernel, if the similarity was set by name
+		self.similarity = None # The (name, args) the kernel was built from, kept by save and load
 		self.num_msg_attributes = 0
-		self.cache = ut.Cache()
-	
-	# A data row is a (user, msg, response) tuple
-	def set_data_rows(self, data_rows):
-		self.cache = ut.Cache()
-		data = ut.Cache()
-		for (u, m, r) in data_rows:
-			if not(data.has_key(u)):
-				data[u] = (u, [], [])
-			_, pos, neg = data[u]
-			if r == 1:
-				pos.append(m)
-			else:
-				neg.append(m)
-		self.data = data.values()
-		if len(data_rows) > 0:
-			self.num_msg_attributes = len(data_rows[0][1])
+		self.cache_entries = cache_entries
+		self.cache_bytes = cache_bytes
+		self.cache = ut.LRUCache(cache_entries, cache_bytes)
+		self.index = None # Optional AttributeIndex over the encoded users
+		self.lsh = None # Optional MinHashIndex over the encoded users (see set_approximate)
+		self.lsh_spec = None # The (num_tables, band_size, seed) of the MinHashIndex
+		self.neighbor_depth = 0 # Minimum number of neighbors searched and cached per user
+		self.responders = None # The data rows with at least one positive message, built on first use
+		self.best_ks = {} # The k chosen by each named find_best_k call, kept by save and load
+		self.shards = [] # (process, connection, first row) of each shard worker (see set_shards)
+		self.shard_directory = None # Where the data was saved for the shard workers
+		self.memo_hits = 0 # Number of designs served from the Neighbors memos
+	
+	# The data as a list of (user, [pos msgs], [neg msgs]) tuples, decoded from the store.
+	@property
+	def data(self):
+		return self.store.entries()
+	
+	# Returns a dict of statistics on the collapsing of identical user profiles: the
+	# number of data rows, the number of distinct profiles they hold, the ratio of the 
+	# two, and the number of designs served from the memos (see memo_design).
+	def dedup_stats(self):
+		rows = len(self.store.pos) + len(self.store.neg)
+		return {'rows': rows, 'profiles': len(self.store), 
+				'ratio': float(rows) / len(self.store) if len(self.store) > 0 else 1.0,
+				'memo_hits': self.memo_hits}
+	
+	# A data row is a (user, msg, response) tuple. Rows of identical users are 
+	# collapsed into one stored profile holding all of their messages, and the
+	# profiles are kept in order of their users' first appearance in the rows.
+	# If index is True, an AttributeIndex is also built to answer match_count queries.
+	def set_data_rows(self, data_rows, index = False):
+		store = TrainingData()
+		store.set_rows(data_rows)
+		self.set_data(store, index)
+	
+	# Replace the data with a TrainingData store, such as one filled block by block 
+	# (see TrainingData.add_encoded_rows). The index is built as in set_data_rows.
+	def set_data(self, store, index = False):
+		self.close_shards()
+		self.cache = ut.LRUCache(self.cache_entries, self.cache_bytes)
+		self.responders = None
+		self.store = store
+		self.index = AttributeIndex(self.store.users) if index else None
+		self.lsh = MinHashIndex(self.store.users, *self.lsh_spec) if self.lsh_spec != None else None
+		self.num_msg_attributes = self.store.msg_encoder.width()
+	
+	# Turn on the approximate mode: neighbors are searched for only among the candidates
+	# found by a MinHashIndex (see lsh.py) with the given number of tables and band size, 
+	# and the candidates are ranked with the real similarity. More tables raise recall 
+	# and cost; longer bands lower both (see approximate_recall). A num_tables of None 
+	# turns the mode off. The index is rebuilt from the same seed whenever the data is set.
+	def set_approximate(self, num_tables = 8, band_size = 2, seed = None):
+		self.close_shards()
+		if num_tables == None:
+			self.lsh_spec, self.lsh = None, None
+		else:
+			seed = seed if seed != None else np.random.randint(2**31 - 1)
+			self.lsh_spec = (num_tables, band_size, seed)
+			self.lsh = MinHashIndex(self.store.users, *self.lsh_spec)
+		self.cache = ut.LRUCache(self.cache_entries, self.cache_bytes)
+	
+	# Adds (user, msg, response) rows to the data in place. Messages of known users join
+	# their groups and new users are appended in order of first appearance, so the data
+	# is as set_data_rows would make it from the earlier rows followed by these.
+	# The encoded users and any index are extended, and only the cached neighbor lists
+	# which the changed users could enter (or which contain them) are dropped.
+	def add_data_rows(self, data_rows):
+		self.close_shards()
+		touched, num_old = self.store.add_rows(data_rows)
+		if self.index != None:
+			self.index.append(self.store.users[num_old:])
+		if self.lsh != None:
+			self.lsh.append(self.store.users[num_old:])
+		self.num_msg_attributes = self.store.msg_encoder.width()
+		self.responders = None
+		self.invalidate_neighbors(touched, num_old)
+	
+	# Removes (user, msg, response) rows from the data in place, taking out one matching
+	# message per row; raises a ValueError if there is none. Users left with no messages
+	# are removed, as set_data_rows would leave them out, and the remaining rows keep 
+	# their order, so the data is as set_data_rows would make it from the rows of self.data
+	# (not from the remaining rows in their original order: a user keeps its place when
+	# the row it first appeared in is retired). Only the cached neighbor lists containing
+	# changed users are dropped.
+	def retire_data_rows(self, data_rows):
+		self.close_shards()
+		touched, removed = self.store.retire_rows(data_rows)
+		self.responders = None
+		self.invalidate_neighbors(touched, len(self.store))
+		if len(removed) > 0:
+			if self.index != None:
+				self.index.remove(removed)
+			if self.lsh != None:
+				self.lsh.remove(removed)
+			for nb in self.cache.values():
+				nb.inds = nb.inds - np.searchsorted(removed, nb.inds)
+	
+	# Drops the cached neighbor lists that contain any of the touched data rows, or 
+	# that any data row from index first_new on could enter. New rows come after all
+	# others, so they only enter a full list by being strictly more similar than its last.
+	def invalidate_neighbors(self, touched, first_new):
+		for (key, nb) in self.cache.items():
+			stale = len(touched.intersection(nb.inds.tolist())) > 0
+			if not(stale) and first_new < len(self.store):
+				if len(nb.inds) < nb.depth:
+					stale = True
+				else:
+					stale = self.similarities(nb.user, first_new).max() > nb.sims[-1]
+			if stale:
+				del(self.cache[key])
 	
 	# Set the distance calculation function.
-	# A similarity_f is a function f : user X user -> R+
-	def set_similarity_f(self, similarity_f):
-		self.similarity_f = similarity_f
-	
-	# Param neighbors: a list of tuples of form: [([message], similarity)]
-	# Returns: set of parsed messages of form [(av1, similarity), (av2, similarity)...]
-	def normalize(self, neighbors):
-		rows = []
-		for (msgs, sim) in neighbors:
-			for msg in msgs:
-				rows.append(map(lambda av: (av, sim), msg))
-		return rows
+	# A similarity_f is a function f : user X user -> R+, or the name of a built-in
+	# similarity kernel (see similarity_kernels) followed by its arguments, if any.
+	# Kernels compute similarities over the encoded data in bulk; match_count itself
+	# is run as the match_count kernel. Any other function is called once per data row.
+	def set_similarity_f(self, similarity_f, *args):
+		self.close_shards()
+		if similarity_f is match_count:
+			similarity_f = 'match_count'
+		if type(similarity_f) == str:
+			self.kernel = build_similarity_kernel(similarity_f, *args)
+			self.similarity = (similarity_f, args)
+			self.similarity_f = match_count if similarity_f == 'match_count' else None
+		else:
+			self.kernel = None
+			self.similarity = None
+			self.similarity_f = similarity_f
+		self.cache = ut.LRUCache(self.cache_entries, self.cache_bytes)
+	
+	# Returns a numpy array holding the similarity of the user to each user in the data
+	# (from index start on), or to the users at the given rows if rows is not None.
+	def similarities(self, user, start = 0, rows = None):
+		if self.kernel != None:
+			return self.kernel(self.store, [user], start, rows)[0]
+		users = self.store.decoded_users()
+		return np.array(map(lambda u: self.similarity_f(user, u), users[start:] if rows is None else map(lambda i: users[i], rows)))
+	
+	# Returns a (len(users) X data size) numpy array of similarities for a block of users.
+	def block_similarities(self, users):
+		if self.kernel != None:
+			return self.kernel(self.store, users)
+		return np.array(map(self.similarities, users))
+	
+	# True if neighbors are found through an index, one user at a time: the MinHashIndex
+	# in approximate mode, or else an AttributeIndex if the kernel ranks by match count.
+	def indexed(self):
+		return self.lsh != None or (self.index != None and hasattr(self.kernel, 'of_match_count'))
+	
+	# Returns parsed messages of form [(av1, similarity), (av2, similarity)...] for the 
+	# positive (or negative) messages of the data rows at the given indices, which 
+	# have the given similarities.
+	def parse_messages(self, inds, sims, positive):
+		rows, owners = self.store.message_rows(inds, positive)
+		msgs = self.store.msg_encoder.decode((self.store.pos if positive else self.store.neg)[rows])
+		return map(lambda (m, o): map(lambda av: (av, sims[o]), m), zip(msgs, owners.tolist()))
+	
+	# Returns the parsed knn-tuples (as returned by knn) for the first k of the Neighbors.
+	def parse_neighbors(self, nb, k):
+		inds, sims = nb.inds[:k], nb.sims[:k]
+		return (self.parse_messages(inds, sims, True), self.parse_messages(inds, sims, False))
 			
 	# Finds the k-nearest-neighbours for a given user, k, and response class.
 	# Returns parsed knn-tuples: ([pos. parsed message], [neg. parsed message])
 	# where a parsed message is of form [(av1, similarity), (av2, similarity)...]
+	# Neighbors are cached per user to a depth of at least neighbor_depth, and 
+	# any k within the cached depth is served from the cached list.
 	def knn(self, user, k):
-		if not(self.cache.has_key(user)):
-			nbs = map(lambda (u, p, n): (u, p, n, self.similarity_f(user, u)), self.data)
-			nn = ut.top_n(nbs, k, lambda (u,p,n,s): s)
-			pos = self.normalize(map(lambda (u,p,n,s): (p,s), nn))
-			neg = self.normalize(map(lambda (u,p,n,s): (n,s), nn))
-			self.cache[user] = (pos, neg)
-		return self.cache[user]
+		return self.parse_neighbors(self.neighbors(user, k), k)
+	
+	# Returns the Neighbors list of the user, covering at least k neighbors, from
+	# the cache if possible. Otherwise it is searched and cached.
+	def neighbors(self, user, k):
+		nb = self.cache.get(user)
+		if nb == None or not(nb.covers(k)):
+			depth = max(k, self.neighbor_depth)
+			inds, sims = self.nearest(user, depth)
+			nb = Neighbors(user, depth, inds, sims.tolist())
+			self.cache[user] = nb
+		return nb
+	
+	# Returns (indices, similarities) of the k data rows most similar to the user,
+	# most similar first, with equally similar rows in data order.
+	# In approximate mode only the candidates from the MinHashIndex are considered.
+	# If the data is sharded, the shards are searched (see shard_nearest).
+	def nearest(self, user, k):
+		if len(self.shards) > 0:
+			return self.shard_nearest([user], k)[0]
+		if self.lsh != None:
+			cands = self.lsh.candidates(self.store.user_encoder.encode_row(user))
+			sims = self.similarities(user, rows = cands)
+			order = ut.top_n_indices(sims, k)
+			return (cands[order], sims[order])
+		return self.nearest_exact(user, k)
+	
+	# As nearest, but always searching exactly, even in approximate mode.
+	def nearest_exact(self, user, k):
+		if self.index != None and hasattr(self.kernel, 'of_match_count'):
+			inds, counts = self.index.top_k(self.store.user_encoder.encode_row(user), k)
+			return (inds, self.kernel.of_match_count(counts, self.index.width))
+		sims = self.similarities(user)
+		inds = ut.top_n_indices(sims, k)
+		return (inds, sims[inds])
+	
+	# Splits the data rows into num_shards contiguous shards, each searched by its own
+	# worker process, until the data or similarity changes or close_shards is called.
+	# The data is saved to a temporary directory (see save) from which each worker
+	# loads only its shard, memory mapped, and builds its own index over it if the
+	# optimizer has one. Any similarity function is inherited as the workers fork. 
+	# Neighbor searches then go to every shard, and the local top k lists are merged
+	# (see merge_top_k) into exactly the neighbors the unsharded optimizer finds.
+	# Messages are still read from this optimizer's store, by global row index.
+	# Shards left open are closed when the program exits (see close_open_shards).
+	def set_shards(self, num_shards):
+		self.close_shards()
+		self.shard_directory = tempfile.mkdtemp()
+		open_shards[self.shard_directory] = self.shards
+		try:
+			self.save(self.shard_directory)
+			bounds = np.linspace(0, len(self.store), num_shards + 1).astype(int).tolist()
+			for (lo, hi) in zip(bounds[:-1], bounds[1:]):
+				conn, worker_conn = multiprocessing.Pipe()
+				p = multiprocessing.Process(target = shard_worker, 
+											args = (worker_conn, self.shard_directory, lo, hi, self.similarity_f))
+				p.daemon = True
+				p.start()
+				worker_conn.close()
+				self.shards.append((p, conn, lo))
+		except:
+			self.close_shards()
+			raise
+		self.cache = ut.LRUCache(self.cache_entries, self.cache_bytes)
+	
+	# Stops the shard workers, if any, and removes their data. Safe to call again, or
+	# after a worker has died.
+	def close_shards(self):
+		if self.shard_directory != None:
+			stop_shards(self.shard_directory, open_shards.pop(self.shard_directory, self.shards))
+		self.shards = []
+		self.shard_directory = None
+	
+	# Returns the (indices, similarities) of the k nearest data rows of each user, as
+	# nearest does, found by sending the users to every shard at once and merging the 
+	# local top k lists. If a shard fails (its worker raised, or died), the shards are
+	# closed before the error is raised, and searches go back to this optimizer's data.
+	def shard_nearest(self, users, k):
+		try:
+			for (p, conn, lo) in self.shards:
+				conn.send((users, k))
+			parts = map(lambda (p, conn, lo): map(lambda (inds, sims): (inds + lo, sims), conn.recv()), self.shards)
+		except:
+			self.close_shards()
+			raise
+		return map(lambda n: merge_top_k(map(lambda part: part[n], parts), k), range(len(users)))
+	
+	# Measures the approximate mode against exact search over the given users: returns
+	# a dict with the recall (the mean fraction of the exact k nearest neighbors that 
+	# the approximate search finds, counting any neighbor as found which is as similar
+	# as the exact k-th) and the total exact and approximate search times in seconds.
+	def approximate_recall(self, users, k):
+		found, total = 0, 0
+		t = time.time()
+		exact = map(lambda u: self.nearest_exact(u, k)[1], users)
+		exact_time = time.time() - t
+		t = time.time()
+		approx = map(lambda u: self.nearest(u, k)[1], users)
+		approx_time = time.time() - t
+		for (e, a) in zip(exact, approx):
+			if len(e) > 0:
+				found += min(len(e), (a >= e[-1]).sum())
+				total += len(e)
+		return {'recall': float(found) / total if total > 0 else 1.0, 
+				'exact_time': exact_time, 'approx_time': approx_time}
 	
 	# Constructs the optimal message for the user given k and the attribute 
 	# selector function. The attribute selector function is of form
 	# f: <positive normalized att. tuples> X <neg. normalized att tuples> -> att value
+	# Repeat profiles reuse the memoized design (see memo_design).
 	def optimize(self, user, k, att_selector_f):
-		pos, neg = self.knn(user, k)
+		return self.memo_design(self.neighbors(user, k), k, att_selector_f, user = user)
+	
+	# Constructs the optimal messages for a block of users at once, returning
+	# them in the same order as users. The block-by-data similarity matrix is
+	# computed tile by tile, with each tile's working memory kept near max_bytes,
+	# and the top k neighbors are selected for every row of a tile together.
+	# If fallback is False, users needing a fallback message get None instead.
+	def optimize_many(self, users, k, att_selector_f, max_bytes = 2**26, fallback = True):
+		tile_size = self.tile_size(max_bytes)
+		depth = max(k, self.neighbor_depth)
+		msgs = []
+		for start in range(0, len(users), tile_size):
+			tile = users[start:start + tile_size]
+			found = {} # The tile's Neighbors lists, kept here in case the cache evicts them
+			todo = []
+			for u in tile:
+				key = ut.hashable(u)
+				if not(found.has_key(key)):
+					found[key] = self.cache.get(u)
+					if found[key] == None or not(found[key].covers(k)):
+						todo.append(u)
+			if len(self.shards) > 0:
+				for (u, (inds, sims)) in zip(todo, self.shard_nearest(todo, depth) if len(todo) > 0 else []):
+					found[ut.hashable(u)] = Neighbors(u, depth, inds, sims.tolist())
+			elif self.indexed():
+				for u in todo:
+					inds, sims = self.nearest(u, depth)
+					found[ut.hashable(u)] = Neighbors(u, depth, inds, sims.tolist())
+			elif len(todo) > 0:
+				sims = self.block_similarities(todo)
+				for (u, row_sims) in zip(todo, sims):
+					row_inds = ut.top_n_indices(row_sims, depth)
+					found[ut.hashable(u)] = Neighbors(u, depth, row_inds, row_sims[row_inds].tolist())
+			for u in todo:
+				self.cache[u] = found[ut.hashable(u)]
+			msgs += map(lambda u: self.memo_design(found[ut.hashable(u)], k, att_selector_f, fallback, u), tile)
+		return msgs
+	
+	# The number of users whose similarities to all the data fit in max_bytes, counting
+	# the kernel's working memory (see work_bytes), or for a similarity function, the
+	# rows of floats and the array made from them.
+	def tile_size(self, max_bytes):
+		sim_bytes = getattr(self.kernel, 'work_bytes', 24) if self.kernel != None else 24
+		return max(1, int(max_bytes / max(1, sim_bytes * len(self.store))))
+	
+	# Constructs the optimal messages for the users on a pool of worker processes, returning
+	# them in the same order as users. The users are split into blocks of block_size which 
+	# the workers design with optimize_many. The data reaches the workers as a copy of the
+	# optimizer saved to a temporary directory (see save), which each one memory maps, so
+	# it is shared rather than pickled to each; the selector and any similarity function 
+	# are inherited as the workers fork. Fallback messages are drawn from per-block seeds
+	# derived from seed (drawn from the global random generator if None), so the results do
+	# not depend on the number of workers. If workers is 1, or this process cannot start 
+	# workers (it is itself a pool worker), the blocks are designed in this process.
+	def optimize_parallel(self, users, k, att_selector_f, workers = None, block_size = 256, seed = None):
+		workers = workers if workers != None else multiprocessing.cpu_count()
+		gen = rd.Random(seed if seed != None else rd.randint(0, 2**31 - 1))
+		blocks = map(lambda start: (users[start:start + block_size], k, gen.randint(0, 2**31 - 1)), 
+					 range(0, len(users), block_size))
+		if workers <= 1 or multiprocessing.current_process().daemon:
+			state = rd.getstate()
+			design_worker['op'], design_worker['selector'] = self, att_selector_f
+			try:
+				msgs = map(design_block, blocks)
+			finally:
+				design_worker.clear()
+				rd.setstate(state)
+		else:
+			directory = tempfile.mkdtemp()
+			try:
+				self.save(directory)
+				pool = multiprocessing.Pool(workers, init_design_worker, 
+											(directory, self.similarity_f, att_selector_f))
+				try:
+					msgs = pool.map(design_block, blocks, 1)
+				finally:
+					pool.close()
+					pool.join()
+			finally:
+				shutil.rmtree(directory)
+		return reduce(lambda x, y: x + y, msgs, [])
+	
+	# Returns the message designed from the first k of the Neighbors with the selector,
+	# memoized in the Neighbors per (k, selector) so that repeat profiles skip selection.
+	# Only whether a fallback is needed is memoized, so each fallback message is still a
+	# fresh random draw (or None, if fallback is False). If the Neighbors are cached for
+	# a user, the cache is given the user so it can count the memo in the entry's size.
+	def memo_design(self, nb, k, att_selector_f, fallback = True, user = None):
+		key = (k, att_selector_f)
+		if nb.designs.has_key(key):
+			self.memo_hits += 1
+		else:
+			if self.store.pos_offsets[nb.inds[:k] + 1].sum() == self.store.pos_offsets[nb.inds[:k]].sum():
+				nb.designs[key] = None
+			elif hasattr(att_selector_f, 'kernel'):
+				nb.designs[key] = self.kernel_design(nb, k, att_selector_f)
+			else:
+				nb.designs[key] = self.design(self.parse_neighbors(nb, k), att_selector_f)
+			if user != None:
+				self.cache.resize(user)
+		if nb.designs[key] == None:
+			return self.fallback_message() if fallback else None
+		return list(nb.designs[key])
+	
+	# Constructs the optimal message from the first k of the Neighbors, of which at least
+	# one responded, with the selector's kernel: the weight of each neighbor is computed 
+	# once, and each message attribute is selected from the level codes of the messages.
+	def kernel_design(self, nb, k, att_selector_f):
+		st = self.store
+		weights = np.array(map(att_selector_f.weight_f, nb.sims[:k]), dtype = float)
+		pos_rows, pos_owners = st.message_rows(nb.inds[:k], True)
+		neg_rows, neg_owners = st.message_rows(nb.inds[:k], False)
+		pos, neg = st.pos[pos_rows], st.neg[neg_rows]
+		pos_w, neg_w = weights[pos_owners], weights[neg_owners]
+		codes = map(lambda j: att_selector_f.kernel(pos[:, j], pos_w, neg[:, j], neg_w), range(self.num_msg_attributes))
+		return st.msg_encoder.decode_row(codes)
+	
+	# Constructs the optimal message from parsed knn-tuples (as returned by knn).
+	def design(self, neighbors, att_selector_f):
+		pos, neg = neighbors
 		if len(pos) == 0:
-			u1, p1, n1 = rd.sample(filter(lambda (u2, p2, n2): len(p2) > 0, self.data), 1)[0]
-			return rd.sample(p1, 1)[0]
+			return self.fallback_message()
 		msg = []
 		for i in range(self.num_msg_attributes):
 			msg.append(att_selector_f(map(lambda x: x[i], pos), map(lambda x: x[i], neg)))
 		return msg
 	
+	# The message used when no neighbors responded: a random positive message.
+	def fallback_message(self):
+		if self.responders == None:
+			self.responders = np.flatnonzero(np.diff(self.store.pos_offsets) > 0).tolist()
+		i = rd.sample(self.responders, 1)[0]
+		return rd.sample(self.store.messages(i, True), 1)[0]
+	
+	# Returns the optimal messages for the user for each k in [min_k, max_k], in
+	# order of k. If the selector carries a tally (see the selector builders), 
+	# neighbors are added one at a time to running per-attribute votes and a
+	# message is read off after each, so the whole range costs one pass over 
+	# the max_k neighbors. Otherwise optimize is called for each k. Votes are
+	# tallied on the encoded messages and only the chosen codes are decoded.
+	# The messages are memoized as in memo_design, and counted in the cache entry's size.
+	def optimize_k_range(self, user, min_k, max_k, att_selector_f):
+		if not(hasattr(att_selector_f, 'tally')):
+			return map(lambda k: self.optimize(user, k, att_selector_f), range(min_k, max_k + 1))
+		nb = self.neighbors(user, max_k)
+		keys = map(lambda k: (k, att_selector_f), range(min_k, max_k + 1))
+		if all(map(nb.designs.has_key, keys)):
+			self.memo_hits += len(keys)
+		else:
+			st = self.store
+			tallies = map(lambda i: att_selector_f.tally(), range(self.num_msg_attributes))
+			num_pos = 0
+			for k in range(1, max_k + 1):
+				if k <= len(nb.inds):
+					i = nb.inds[k - 1]
+					w = att_selector_f.weight_f(nb.sims[k - 1])
+					for (codes, offsets, positive) in [(st.pos, st.pos_offsets, True), (st.neg, st.neg_offsets, False)]:
+						for m in codes[offsets[i]:offsets[i + 1]].tolist():
+							for j in range(self.num_msg_attributes):
+								tallies[j].add(m[j], w, positive)
+					num_pos += st.num_messages(i, True)
+				if k >= min_k:
+					nb.designs[(k, att_selector_f)] = st.msg_encoder.decode_row(map(lambda t: t.select(), tallies)) \
+													  if num_pos > 0 else None
+			self.cache.resize(user)
+		return map(lambda key: list(nb.designs[key]) if nb.designs[key] != None else self.fallback_message(), keys)
+	
 	# Using the specified calibration data and response function,
 	# returns the best k in range [min_k, max_k].
 	# Calibration data is a set of users
 	# att_selector is function of form f: <positive normalized att. tuples> X <neg. normalized att tuples> -> att value
 	# A response function is of form f: user X message -> {0 | 1}
-	def find_best_k(self, calibration_data, min_k, max_k, att_selector_f, response_f):
-		k = min_k
+	# Each calibration user's neighbors are searched once, to a depth of max_k,
+	# and the messages for every k in the sweep are built in one pass.
+	# If a name is given, the best k is also kept in self.best_ks under that name.
+	def find_best_k(self, calibration_data, min_k, max_k, att_selector_f, response_f, name = None):
+		self.neighbor_depth = max(self.neighbor_depth, max_k)
+		responses = map(lambda k: 0, range(min_k, max_k + 1))
+		for u in calibration_data:
+			msgs = self.optimize_k_range(u, min_k, max_k, att_selector_f)
+			responses = map(lambda (r, m): r + response_f(u, m), zip(responses, msgs))
 		best_k = min_k
 		best_resp_rate = 0.0
-		while k <= max_k:
-			get_response = lambda u: response_f(u, self.optimize(u, k, att_selector_f))
-			resp_rate = float(sum(map(get_response, calibration_data))) / float(len(calibration_data))
+		for (k, r) in zip(range(min_k, max_k + 1), responses):
+			resp_rate = float(r) / float(len(calibration_data))
 			if resp_rate > best_resp_rate:
 				best_k = k
 				best_resp_rate = resp_rate
-			k += 1
+		if name != None:
+			self.best_ks[name] = best_k
 		return best_k
-		
 	
+	# Save the optimizer into the given directory (created if needed): the training
+	# data arrays and level dictionaries (see TrainingData.save), the neighbor index
+	# if any, the neighbor depth, the named best k values, the similarity kernel if
+	# it was set by name, and the approximate mode settings (its MinHashIndex is 
+	# rebuilt on load). Similarity functions and the neighbor cache are not saved.
+	def save(self, directory):
+		self.store.save(directory)
+		if self.index != None:
+			rows, bounds = self.index.arrays()
+			np.save(os.path.join(directory, 'index_rows.npy'), rows)
+		else:
+			bounds = None
+		f = open(os.path.join(directory, 'optimizer.pkl'), 'wb')
+		cPickle.dump({'neighbor_depth': self.neighbor_depth, 'best_ks': self.best_ks, 
+					  'index_bounds': bounds, 'similarity': self.similarity, 'lsh_spec': self.lsh_spec}, f, 2)
+		f.close()
+	
+	# Load an optimizer saved into the given directory, replacing the data of this one.
+	# The arrays are memory mapped read-only by default (see TrainingData.load), so 
+	# startup does not depend on the data size and worker processes loading the same
+	# directory share one copy. A similarity function (rather than a kernel) must be set again.
+	# If rows is a (lo, hi) pair, only data rows lo to hi - 1 are loaded (see TrainingData.shard),
+	# and any neighbor index is built over them rather than read.
+	def load(self, directory, mmap_mode = 'r', rows = None):
+		self.close_shards()
+		self.cache = ut.LRUCache(self.cache_entries, self.cache_bytes)
+		self.responders = None
+		self.store = TrainingData().load(directory, mmap_mode)
+		if rows != None:
+			self.store = self.store.shard(*rows)
+		self.num_msg_attributes = self.store.msg_encoder.width()
+		f = open(os.path.join(directory, 'optimizer.pkl'), 'rb')
+		state = cPickle.load(f)
+		f.close()
+		self.neighbor_depth = state['neighbor_depth']
+		self.best_ks = state['best_ks']
+		if state['similarity'] != None:
+			name, args = state['similarity']
+			self.set_similarity_f(name, *args)
+		self.index = None
+		if state['index_bounds'] != None and rows != None:
+			self.index = AttributeIndex(self.store.users)
+		elif state['index_bounds'] != None:
+			index_rows = np.load(os.path.join(directory, 'index_rows.npy'), mmap_mode = mmap_mode)
+			self.index = AttributeIndex(np.zeros((0, 0), dtype = np.int8)).restore(index_rows, state['index_bounds'])
+		self.lsh_spec = state['lsh_spec']
+		self.lsh = MinHashIndex(self.store.users, *self.lsh_spec) if self.lsh_spec != None else None
+		return self
+
+# -------------------- PARALLEL DESIGN WORKERS --------------------
+# The optimizer and selector of a design worker (see KNNOptimizer.optimize_parallel).
+design_worker = {}
+
+# Initializes a design worker process: loads the optimizer saved in the directory, 
+# memory mapping its arrays so that the workers share them, and keeps the selector. 
+# The similarity function is set unless a similarity kernel was loaded with the data.
+def init_design_worker(directory, similarity_f, att_selector_f):
+	op = KNNOptimizer().load(directory)
+	if op.similarity == None:
+		op.set_similarity_f(similarity_f)
+	design_worker['op'] = op
+	design_worker['selector'] = att_selector_f
+
+# Designs the messages for a (users, k, seed) block in a design worker, drawing any
+# fallback messages from the block's seed.
+def design_block((users, k, seed)):
+	rd.seed(seed)
+	return design_worker['op'].optimize_many(users, k, design_worker['selector'])
+
+# -------------------- SHARD WORKERS ------------------------------
+# The (process, connection, first row) lists of the shard workers of every optimizer
+# with open shards, by their data directory (see KNNOptimizer.set_shards).
+open_shards = {}
+
+# Stops the given shard workers and removes their data directory. Workers which do not
+# stop when asked (or have died) are terminated, and a missing directory is ignored.
+def stop_shards(directory, shards):
+	for (p, conn, lo) in shards:
+		try:
+			conn.send(None)
+		except (IOError, OSError, ValueError):
+			pass
+	for (p, conn, lo) in shards:
+		p.join(5)
+		if p.is_alive():
+			p.terminate()
+			p.join()
+		conn.close()
+	shutil.rmtree(directory, ignore_errors = True)
+
+# Stops the shard workers of every optimizer whose shards are still open, as when the
+# program exits without calling close_shards.
+def close_open_shards():
+	for directory in open_shards.keys():
+		stop_shards(directory, open_shards.pop(directory))
+
+atexit.register(close_open_shards)
+
+# Merges the (indices, similarities) top k lists of the shards, given in shard order, 
+# into the overall top k: most similar first, and equally similar rows in row order.
+def merge_top_k(parts, k):
+	inds = np.concatenate(map(lambda (i, s): i, parts))
+	sims = np.concatenate(map(lambda (i, s): s, parts))
+	order = np.argsort(-sims, kind = 'mergesort')[:k]
+	return (inds[order], sims[order])
+
+# The main loop of a shard worker process: loads data rows lo to hi - 1 of the optimizer
+# saved in the directory, then answers (users, k) requests from the connection with the 
+# (local indices, similarities) of each user's k nearest rows, until it receives None.
+def shard_worker(conn, directory, lo, hi, similarity_f):
+	op = KNNOptimizer().load(directory, rows = (lo, hi))
+	if op.similarity == None:
+		op.set_similarity_f(similarity_f)
+	request = conn.recv()
+	while request != None:
+		users, k = request
+		conn.send(map(lambda u: op.nearest(u, k), users))
+		request = conn.recv()
+	conn.close()
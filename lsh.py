@@ -0,0 +1,76 @@
+# --------------------------------------------------------------------------------------
+# About: This file provides a MinHash locality-sensitive hash index over integer-encoded
+#        users, used by the nearest-neighbor optimizer's approximate mode to find
+#        candidate neighbors without scoring every user.
+# --------------------------------------------------------------------------------------
+
+import numpy as np
+
+PRIME = 2**31 - 1 # Modulus of the hash functions
+
+# This class treats each row of an encoded user matrix (see util.LevelEncoder) as the set
+# of its (attribute position, code) pairs, and keeps num_tables hash tables over their
+# MinHash signatures. Each table hashes a band of band_size signature values, so two
+# rows with Jaccard similarity s share a bucket in a table with probability s^band_size.
+# More tables find more of the true neighbors; longer bands make the buckets smaller.
+class MinHashIndex(object):
+	def __init__(self, codes, num_tables = 8, band_size = 2, seed = None):
+		self.num_tables = num_tables
+		self.band_size = band_size
+		rs = np.random.RandomState(seed if seed != None else np.random.randint(PRIME))
+		self.a = rs.randint(1, PRIME, num_tables * band_size).astype(np.int64)
+		self.b = rs.randint(0, PRIME, num_tables * band_size).astype(np.int64)
+		self.r = rs.randint(1, PRIME, band_size).astype(np.int64) # Mixes a band into one bucket key
+		self.size = 0
+		self.tables = map(lambda t: {}, range(num_tables)) # tables[t] is {bucket key: ascending rows}
+		self.append(codes)
+	
+	# Returns the (rows X num_tables * band_size) MinHash signatures of an encoded user matrix.
+	# Unseen values (code -1) are left out of the sets.
+	def signatures(self, codes):
+		codes = np.asarray(codes, dtype = np.int64)
+		tokens = (np.arange(codes.shape[1], dtype = np.int64) * 2**32 + codes) % PRIME
+		sigs = np.empty((len(codes), len(self.a)), dtype = np.int64)
+		for h in range(len(self.a)):
+			vals = (self.a[h] * tokens + self.b[h]) % PRIME
+			vals[codes < 0] = PRIME
+			sigs[:, h] = vals.min(axis = 1) if codes.shape[1] > 0 else PRIME
+		return sigs
+	
+	# Returns the (rows X num_tables) bucket keys of the signatures.
+	def bucket_keys(self, sigs):
+		keys = np.zeros((len(sigs), self.num_tables), dtype = np.int64)
+		for t in range(self.num_tables):
+			for i in range(self.band_size):
+				keys[:, t] = (keys[:, t] + sigs[:, t * self.band_size + i] * self.r[i]) % PRIME
+		return keys
+	
+	# Returns the ascending array of rows sharing a bucket with the encoded query in any table.
+	def candidates(self, query):
+		keys = self.bucket_keys(self.signatures(np.asarray(query).reshape(1, len(query))))[0]
+		found = filter(lambda rows: rows is not None, map(lambda (h, key): h.get(key), zip(self.tables, keys)))
+		return np.unique(np.concatenate(found)) if len(found) > 0 else np.zeros(0, dtype = np.int64)
+	
+	# Add the rows of an encoded user matrix to the index, numbered on from the current rows.
+	def append(self, codes):
+		keys = self.bucket_keys(self.signatures(codes))
+		for (h, col) in zip(self.tables, keys.T):
+			order = np.argsort(col, kind = 'mergesort')
+			ukeys, starts = np.unique(col[order], return_index = True)
+			bounds = np.append(starts, len(col))
+			for (n, key) in enumerate(ukeys.tolist()):
+				rows = self.size + order[bounds[n]:bounds[n + 1]]
+				h[key] = np.concatenate((h[key], rows)) if h.has_key(key) else rows
+		self.size += len(codes)
+	
+	# Remove the rows at the given indices. Remaining rows are renumbered in order.
+	def remove(self, inds):
+		inds = np.unique(inds)
+		for h in self.tables:
+			for (key, rows) in h.items():
+				kept = rows[~np.in1d(rows, inds)]
+				if len(kept) > 0:
+					h[key] = kept - np.searchsorted(inds, kept)
+				else:
+					del(h[key])
+		self.size -= len(inds)
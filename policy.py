@@ -0,0 +1,183 @@
+# --------------------------------------------------------------------------------------
+# About: This file provides a policy table: the message the nearest-neighbor optimizer
+#        designs for every possible user profile, compiled ahead of time so that
+#        serving a user is an array lookup.
+# --------------------------------------------------------------------------------------
+
+import os
+import cPickle
+import shutil
+import tempfile
+import multiprocessing
+import util as ut
+import numpy as np
+from knn import KNNOptimizer
+
+# This class is a table of the messages a KNNOptimizer designs, with a fixed k and
+# attribute selector, for every possible user profile: every combination of the levels
+# of the user attributes (see ut.MixedRadixSpace). Row i of the table holds the message
+# of the profile with mixed-radix code i, as message level codes (see ut.LevelEncoder).
+# Profiles whose nearest neighbors have no positive message are marked instead, and get
+# a fresh random fallback message when served, as from the optimizer. Users outside the
+# table (with unseen levels, or any user if some user attribute is continuous) are
+# designed live by the optimizer. The table holds the designs for the optimizer's data
+# when compiled, so it is compiled again (see compile) when the data changes.
+# The user attributes and k may be left out if the table is to be loaded (see load).
+class PolicyTable(object):
+	def __init__(self, op, att_selector_f, user_attrs = [], k = None):
+		self.op = op
+		self.att_selector_f = att_selector_f
+		self.k = k
+		self.msg_encoder = None # The optimizer's message encoder when compiled
+		self.codes = None # (profiles X message attributes) level codes of the messages
+		self.designed = None # designed[i] is False if profile i gets a fallback message
+		self.set_user_attrs(user_attrs)
+	
+	# Set the user attributes, as (name, levels) pairs, whose profiles the table covers.
+	# If any attribute is continuous (its levels a (min, max) pair) there is no table.
+	def set_user_attrs(self, user_attrs):
+		self.user_attrs = user_attrs
+		if all(map(lambda (name, levels): type(levels) == type([]), user_attrs)):
+			self.space = ut.MixedRadixSpace(map(lambda (name, levels): levels, user_attrs))
+			self.level_codes = map(lambda (name, levels): dict(zip(levels, range(len(levels)))), user_attrs)
+		else:
+			self.space = None
+			self.level_codes = None
+	
+	# Design the message of every profile into the table, replacing any earlier ones, in
+	# batches of batch_size profiles spread over a pool of workers (all available cores
+	# if None). The workers load a copy of the optimizer saved to a temporary directory,
+	# memory mapping its data as in KNNOptimizer.optimize_parallel, and make the profiles
+	# of their batches themselves, so only the message codes are sent back. If workers is
+	# 1, or this process cannot start workers, the batches are designed in this process.
+	# Returns self.
+	def compile(self, workers = None, batch_size = 4096):
+		if self.space == None:
+			return self
+		workers = workers if workers != None else multiprocessing.cpu_count()
+		batches = map(lambda start: (start, min(start + batch_size, len(self.space))),
+					  xrange(0, len(self.space), batch_size))
+		directory = tempfile.mkdtemp()
+		try:
+			self.op.save(directory)
+			args = (directory, self.op.similarity_f, self.space, self.k, self.att_selector_f)
+			if workers <= 1 or multiprocessing.current_process().daemon:
+				init_policy_worker(*args)
+				try:
+					parts = map(compile_batch, batches)
+				finally:
+					policy_worker.clear()
+			else:
+				pool = multiprocessing.Pool(workers, init_policy_worker, args)
+				try:
+					parts = pool.map(compile_batch, batches, 1)
+				finally:
+					pool.close()
+					pool.join()
+		finally:
+			shutil.rmtree(directory)
+		self.msg_encoder = self.op.store.msg_encoder
+		width = self.msg_encoder.width()
+		self.codes = np.concatenate(map(lambda (codes, designed): codes, parts)) if len(parts) > 0 \
+					 else np.zeros((0, width), dtype = self.msg_encoder.dtype())
+		self.designed = np.concatenate(map(lambda (codes, designed): designed, parts)) if len(parts) > 0 \
+						else np.zeros(0, dtype = bool)
+		return self
+	
+	# The table row of the user's profile, or None if the profile is not in the table.
+	def profile_code(self, user):
+		if self.codes is None or len(user) != len(self.level_codes):
+			return None
+		try:
+			return sum(map(lambda (h, v, stride): h[v] * stride,
+						   zip(self.level_codes, user, self.space.strides.tolist())))
+		except (KeyError, TypeError):
+			return None
+	
+	# Returns the message for the user: from the table if the user's profile is in it,
+	# otherwise designed live by the optimizer.
+	def message(self, user):
+		i = self.profile_code(user)
+		if i == None:
+			return self.op.optimize(user, self.k, self.att_selector_f)
+		return self.msg_encoder.decode_row(self.codes[i]) if self.designed[i] else self.op.fallback_message()
+	
+	def __call__(self, user):
+		return self.message(user)
+	
+	# Returns the messages for a list of users, in the same order. Profiles in the table
+	# are looked up and decoded together, and the other users designed live in one batch
+	# (see KNNOptimizer.optimize_many).
+	def messages(self, users):
+		inds = map(self.profile_code, users)
+		live = filter(lambda n: inds[n] == None, range(len(users)))
+		found = filter(lambda n: inds[n] != None, range(len(users)))
+		msgs = map(lambda u: None, users)
+		for (n, m) in zip(live, self.op.optimize_many(map(lambda n: users[n], live), self.k, self.att_selector_f)):
+			msgs[n] = m
+		rows = np.array(map(lambda n: inds[n], found), dtype = np.int64)
+		for (n, i, m) in zip(found, rows.tolist(), self.msg_encoder.decode(self.codes[rows]) if len(found) > 0 else []):
+			msgs[n] = m if self.designed[i] else self.op.fallback_message()
+		return msgs
+	
+	# Returns a dict of statistics on the table: the number of profiles, and the number
+	# and fraction of them which get a fallback message.
+	def stats(self):
+		size = len(self.codes) if self.codes is not None else 0
+		fallbacks = size - int(self.designed.sum()) if size > 0 else 0
+		return {'profiles': size, 'fallbacks': fallbacks,
+				'fallback_frac': float(fallbacks) / size if size > 0 else 0.0}
+	
+	# Save the compiled table into the given directory (created if needed): the message
+	# codes and marks as .npy files, and the user attributes, k, and message levels in
+	# policy.pkl. The optimizer and selector are not saved. Raises a ValueError if the
+	# table has not been compiled (or loaded).
+	def save(self, directory):
+		if self.codes is None:
+			raise ValueError('table not compiled')
+		if not(os.path.isdir(directory)):
+			os.makedirs(directory)
+		np.save(os.path.join(directory, 'policy_codes.npy'), self.codes)
+		np.save(os.path.join(directory, 'policy_designed.npy'), self.designed)
+		f = open(os.path.join(directory, 'policy.pkl'), 'wb')
+		cPickle.dump({'user_attrs': self.user_attrs, 'k': self.k, 'msg_levels': self.msg_encoder.levels}, f, 2)
+		f.close()
+	
+	# Load a table saved into the given directory, replacing this one, to serve with this
+	# table's optimizer and selector (which should be those it was compiled with). The
+	# arrays are memory mapped read-only by default, as in TrainingData.load. Returns self.
+	def load(self, directory, mmap_mode = 'r'):
+		f = open(os.path.join(directory, 'policy.pkl'), 'rb')
+		state = cPickle.load(f)
+		f.close()
+		self.set_user_attrs(state['user_attrs'])
+		self.k = state['k']
+		self.msg_encoder = ut.LevelEncoder()
+		self.msg_encoder.levels = state['msg_levels']
+		self.msg_encoder.codes = map(lambda levs: dict(zip(levs, range(len(levs)))), state['msg_levels'])
+		self.codes = np.load(os.path.join(directory, 'policy_codes.npy'), mmap_mode = mmap_mode)
+		self.designed = np.load(os.path.join(directory, 'policy_designed.npy'), mmap_mode = mmap_mode)
+		return self
+
+# -------------------- POLICY WORKERS -----------------------------
+# The optimizer, profile space, k, and selector of a policy worker (see PolicyTable.compile).
+policy_worker = {}
+
+# Initializes a policy worker: loads the optimizer saved in the directory, memory mapping
+# its arrays, with a cache of one entry since every profile is searched once. The
+# similarity function is set unless a similarity kernel was loaded with the data.
+def init_policy_worker(directory, similarity_f, space, k, att_selector_f):
+	op = KNNOptimizer(cache_entries = 1).load(directory)
+	if op.similarity == None:
+		op.set_similarity_f(similarity_f)
+	policy_worker.update({'op': op, 'space': space, 'k': k, 'selector': att_selector_f})
+
+# Designs the messages of the profiles with codes start to stop - 1 in a policy worker.
+# Returns (message codes, designed marks) arrays, as held in a PolicyTable.
+def compile_batch((start, stop)):
+	w = policy_worker
+	profiles = w['space'].combinations(np.arange(start, stop))
+	msgs = w['op'].optimize_many(profiles, w['k'], w['selector'], fallback = False)
+	blank = map(lambda j: None, range(w['op'].num_msg_attributes))
+	codes = w['op'].store.msg_encoder.encode(map(lambda m: m if m != None else blank, msgs))
+	return (codes, np.array(map(lambda m: m != None, msgs), dtype = bool))
@@ -0,0 +1,105 @@
+# --------------------------------------------------------------------------------------
+# About: This file runs a suite of scenarios concurrently. The trials of all scenarios
+#        share one pool of worker processes, the longest scenarios are started first,
+#        and each scenario's output file is written as soon as its trials finish.
+#        Usage: python run_suite.py [-w WORKERS] <params dir, file, or glob> ...
+#        Example: python run_suite.py -w 32 ./params
+# --------------------------------------------------------------------------------------
+
+import argparse
+import glob
+import multiprocessing
+import os
+import random as rd
+import re
+import util as ut
+import scenario_util as su
+from scenario_runner import Scenario
+
+# Expand the given directories, files, and glob patterns into a sorted list of params files.
+def params_files(specs):
+	files = []
+	for spec in specs:
+		if os.path.isdir(spec):
+			files += glob.glob(os.path.join(spec, '*.csv'))
+		else:
+			files += glob.glob(spec)
+	return sorted(set(files))
+
+# Estimate the time in seconds of one trial of the scenario from its previous results
+# file, if there is one. The total trial time is used when the results report it,
+# otherwise the total elapsed time. Returns None if no estimate can be made.
+def estimated_trial_time(scenario):
+	if scenario.output_file == None or not(os.path.isfile(scenario.output_file)):
+		return None
+	fl = open(scenario.output_file)
+	txt = fl.read()
+	fl.close()
+	trials = re.search(r'Number of trials:\s*(\d+)', txt)
+	elapsed = re.search(r'TOTAL TRIAL TIME:\s*([\d.]+)', txt) or re.search(r'TOTAL ELAPSED TIME:\s*([\d.]+)', txt)
+	if trials == None or elapsed == None or int(trials.group(1)) == 0:
+		return None
+	return float(elapsed.group(1)) / float(trials.group(1))
+
+# Order scenarios longest first by estimated trial time. Scenarios with no 
+# estimate are assumed to be the longest.
+def schedule(scenarios):
+	ests = map(estimated_trial_time, scenarios)
+	longest = max(filter(lambda x: x != None, ests) + [0.0])
+	ranked = sorted(zip(scenarios, ests), key = lambda (s, e): longest + 1.0 if e == None else e, reverse = True)
+	return map(lambda (s, e): s, ranked)
+
+# Runs one trial of one scenario. Takes a single (scenario number, scenario, trial number, 
+# seed) tuple so it can be mapped over a pool. Returns the scenario and trial numbers along
+# with the trial's su.run_single_trial result.
+def run_suite_trial((i, scenario, t, seed)):
+	return (i, t, su.run_single_trial((scenario, t, seed)))
+
+# Runs all trials of the scenarios on a shared pool of the given number of workers.
+# Each scenario's results are analyzed and written to its output file when its last
+# trial finishes. Trial seeds are derived from each scenario's seed as in su.run_trials.
+def run_suite(scenarios, workers):
+	scenarios = schedule(scenarios)
+	start_time = ut.curr_time()
+	tasks = []
+	results = []
+	for (i, scen) in enumerate(scenarios):
+		if scen.seed == None:
+			scen.seed = rd.randint(0, 2**31 - 1)
+		seeds = su.trial_seeds(scen.seed, scen.num_trials)
+		tasks += map(lambda (t, seed): (i, scen, t, seed), zip(range(1, scen.num_trials + 1), seeds))
+		results.append({})
+	pool = multiprocessing.Pool(workers)
+	try:
+		for (i, t, result) in pool.imap_unordered(run_suite_trial, tasks, 1):
+			results[i][t] = result
+			scen = scenarios[i]
+			if len(results[i]) == scen.num_trials:
+				finish_scenario(scen, map(lambda t: results[i][t], sorted(results[i].keys())), start_time)
+	finally:
+		pool.close()
+		pool.join()
+	print('Suite finished in ' + str(ut.curr_time() - start_time) + ' sec.')
+
+# Merge a scenario's trial results (in trial order), analyze them, and write the output file.
+def finish_scenario(scenario, trial_results, start_time):
+	recorder = su.ScenarioRecorder()
+	logger = su.BasicLogger()
+	recorder.set('num_trials', scenario.num_trials)
+	recorder.set('seed', scenario.seed)
+	for (records, lines, solver_names) in trial_results:
+		recorder.merge(records)
+		logger.lines += lines
+	recorder.set('main.elapsed_time', ut.curr_time() - start_time)
+	logger.log('Finished scenario: ' + scenario.params_file, 'standard')
+	su.standard_analyzer_f(recorder, logger, solver_names)
+	if scenario.output_file != None:
+		logger.write(scenario.output_file)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Run a suite of scenarios concurrently.')
+	parser.add_argument('params', nargs = '+', help = 'params files, directories of them, or glob patterns')
+	parser.add_argument('-w', '--workers', type = int, default = multiprocessing.cpu_count(),
+						help = 'number of worker processes shared by all scenarios')
+	args = parser.parse_args()
+	run_suite(map(Scenario, params_files(args.params)), args.workers)
@@ -1,72 +1,128 @@
 # --------------------------------------------------------------------------------------
 # Author: cgarcia@umw.edu
-# About: This file runs a scenario based on the parameters in the specified parameter 
+# About: This file runs a scenario based on the parameters in the specified parameter
 #        file. To see some example parameter files, look in the "params" folder.
+#        Usage: python scenario_runner.py <params file>
 # --------------------------------------------------------------------------------------
 
 from os import sys
 from data_gen import *
 from knn import *
+from training_data import TrainingData
 import random as rd
 import util as ut
 import scenario_util as su
 
-params = None
-try:
-	params = ut.read_params(sys.argv[1], ignore_lines = '#')
-except:
-	params = ut.read_params(sys.argv[1], ignore_lines = '#')
+# This class holds a scenario read from a parameter file. A Scenario is a
+# trial_initializer_f (see su.run_trials): calling it initializes a new trial.
+# When pickled (e.g. to be sent to a worker process) only the parameter file
+# name is kept, and the parameters are read again on the other side.
+class Scenario(object):
+	def __init__(self, params_file):
+		self.params_file = params_file
+		self.load()
 
-# Get params when possible from the set of params, otherwise
-# return the specified default.	
-def p(param_name, default):
-	try:
-		return params[param_name]
-	except:
-		return default
-		
-# Main parameters.
-num_trials = p('num_trials', 5)
-baseline = p('baseline_prob', 0.02)
-num_user_atts, min_user_att_levels, max_user_att_levels = p('user_attribute_spec', (4, 2, 4))
-num_msg_atts, min_msg_att_levels, max_msg_att_levels = p('msg_attribute_spec', (4, 2, 4))
-num_propensity_groups = p('num_propensity_groups', 5)
-min_group_user_atts, max_group_user_atts = p('minmax_user_propensity_attrs_involved', (3, 4))
-min_group_msg_atts, max_group_msg_atts = p('minmax_msg_propensity_attrs_involved', (2, 4))
-min_group_pos_prob, max_group_pos_prob = p('minmax_propensity_group_response_prob', (0.2, 0.85))
-num_users = p('num_users', 1000)
-num_test_messages = p('num_test_messages', 100)
-output_file = p('output_file', None)
+	def __getstate__(self):
+		return {'params_file': self.params_file}
 
-# Initializer function
-def trial_init(recdr, logr):
-	logr.log('Initializing new trial...', 'standard')
-	b = DataGenerator()
-	b.set_baseline_response_prob(baseline)
-	b.add_random_user_attrs(num_user_atts, min_user_att_levels, max_user_att_levels) 
-	b.add_random_inter_attrs(num_msg_atts, min_msg_att_levels, max_msg_att_levels) 
-	templates = b.set_random_propensities(num_propensity_groups, 
-							  min_group_user_atts, max_group_user_atts, 
-							  min_group_msg_atts, max_group_msg_atts,
-							  min_group_pos_prob, max_group_pos_prob)
-	# -> Returns: a pair (user templates, interaction templates)
-	logr.log('Generating data...', 'standard')
-	messages = b.gen_random_inters(num_test_messages)
-	users = b.gen_random_users(num_users)
-	rows = ut.unzip(b.gen_random_rows_from(users, messages))
-	logr.log('Number of rows: ' + str(len(rows)), 'standard')
-	# Split data into train, calibration, and test.
-	train, calibrate, test = ut.split_data(rows, 0.5, 0.25, 0.25)
-	calibration_users = map(lambda (u, m, r): u, calibrate)
-	test_users = map(lambda (u, m, r): u, test)
-	controls = su.build_std_control_solvers(calibrate, b, messages, 15)
-	treatments = su.build_std_knn_optims(train, calibrate, b, recorder, 1, 15)
-	solvers = controls + treatments
-	return (train, test_users, b, solvers)
+	def __setstate__(self, state):
+		self.params_file = state['params_file']
+		self.load()
 
-logger = su.BasicLogger()
-recorder = su.ScenarioRecorder()
+	# Read the parameters from the parameter file.
+	def load(self):
+		self.params = ut.read_params(self.params_file, ignore_lines = '#')
+		p = self.p
+		# Main parameters.
+		self.num_trials = p('num_trials', 5)
+		self.baseline = p('baseline_prob', 0.02)
+		self.num_user_atts, self.min_user_att_levels, self.max_user_att_levels = p('user_attribute_spec', (4, 2, 4))
+		self.num_msg_atts, self.min_msg_att_levels, self.max_msg_att_levels = p('msg_attribute_spec', (4, 2, 4))
+		self.num_propensity_groups = p('num_propensity_groups', 5)
+		self.min_group_user_atts, self.max_group_user_atts = p('minmax_user_propensity_attrs_involved', (3, 4))
+		self.min_group_msg_atts, self.max_group_msg_atts = p('minmax_msg_propensity_attrs_involved', (2, 4))
+		self.min_group_pos_prob, self.max_group_pos_prob = p('minmax_propensity_group_response_prob', (0.2, 0.85))
+		self.num_users = p('num_users', 1000)
+		self.num_test_messages = p('num_test_messages', 100)
+		self.output_file = p('output_file', None)
+		self.num_workers = p('num_workers', 1)
+		self.seed = p('seed', None)
+		self.similarity = str(p('similarity', 'match_count')).strip() # A knn.similarity_kernels name
+		self.similarity_weights = p('similarity_weights', None) # For the weighted_match similarity
+		self.lsh_spec = p('lsh_spec', None) # (number of tables, band size) for approximate neighbors
+		self.design_workers = p('design_workers', 1) # Processes designing each KNN solver's messages
+		self.stream_block_size = p('stream_block_size', None) # If set, rows are generated in blocks (see split_rows)
+		self.stratify_splits = p('stratify_splits', False) # If true, rows are split in proportion by response
+		self.policy_table = p('policy_table', False) # If true, KNN messages are served from policy tables
+
+	# Get params when possible from the set of params, otherwise
+	# return the specified default.
+	def p(self, param_name, default):
+		try:
+			return self.params[param_name]
+		except:
+			return default
+
+	# Initializer function
+	def __call__(self, recdr, logr):
+		logr.log('Initializing new trial...', 'standard')
+		b = DataGenerator()
+		b.set_baseline_response_prob(self.baseline)
+		b.add_random_user_attrs(self.num_user_atts, self.min_user_att_levels, self.max_user_att_levels)
+		b.add_random_inter_attrs(self.num_msg_atts, self.min_msg_att_levels, self.max_msg_att_levels)
+		templates = b.set_random_propensities(self.num_propensity_groups,
+								  self.min_group_user_atts, self.max_group_user_atts,
+								  self.min_group_msg_atts, self.max_group_msg_atts,
+								  self.min_group_pos_prob, self.max_group_pos_prob)
+		# -> Returns: a pair (user templates, interaction templates)
+		logr.log('Generating data...', 'standard')
+		messages = b.gen_random_inters(self.num_test_messages)
+		if self.stream_block_size != None:
+			train, calibration_users, test_users, num_rows = self.split_rows(b, messages)
+			logr.log('Number of rows: ' + str(num_rows), 'standard')
+		else:
+			users = b.gen_random_users(self.num_users)
+			rows = ut.unzip(b.gen_random_rows_from(users, messages))
+			logr.log('Number of rows: ' + str(len(rows)), 'standard')
+			# Split data into train, calibration, and test views over the rows.
+			strata = map(lambda (u, m, r): r, rows) if self.stratify_splits else None
+			train, calibrate, test = ut.split_views(rows, (0.5, 0.25, 0.25), strata)
+			calibration_users = calibrate.column(0)
+			test_users = test.column(0)
+		controls = su.build_std_control_solvers(calibration_users, b, messages, 15)
+		similarity_args = (self.similarity_weights,) if self.similarity_weights != None else ()
+		treatments = su.build_std_knn_optims(train, calibration_users, b, recdr, 1, 15, 
+											 self.similarity, similarity_args, self.lsh_spec, self.design_workers,
+											 self.policy_table)
+		solvers = controls + treatments
+		return (train, test_users, b, solvers)
 	
-su.run_trials(trial_init, su.standard_analyzer_f, num_trials, recorder, logger)
-if output_file != None:
-	logger.write(output_file)
+	# Generates the rows in blocks of stream_block_size and routes each block's rows
+	# into train, calibration, and test splits (0.5, 0.25, 0.25 on average) as it goes.
+	# Training blocks go straight into a TrainingData store, still encoded (see 
+	# TrainingData.add_encoded_rows). Of the calibration and test blocks only the user
+	# codes are kept, and only those users are decoded, since the trial needs them as lists.
+	# Returns: (training store, calibration users, test users, number of rows)
+	def split_rows(self, data_gen, messages):
+		b = data_gen
+		levels = lambda attrs: map(lambda (name, levs): levs, attrs)
+		store = TrainingData()
+		users = {1: [], 2: []}
+		num_rows = 0
+		for (i, (user_codes, inter_codes, resps)) in ut.split_blocks(b.gen_row_blocks(self.num_users, messages, 
+																					   self.stream_block_size), 0.5, 0.25, 0.25):
+			num_rows += len(resps)
+			if i == 0:
+				store.add_encoded_rows(user_codes, inter_codes, resps, levels(b.user_attrs), levels(b.inter_attrs))
+			else:
+				users[i].extend(b.decode_entities(user_codes, b.user_attrs))
+		return (store, users[1], users[2], num_rows)
+
+if __name__ == '__main__':
+	scenario = Scenario(sys.argv[1])
+	logger = su.BasicLogger()
+	recorder = su.ScenarioRecorder()
+	su.run_trials(scenario, su.standard_analyzer_f, scenario.num_trials, recorder, logger,
+				  scenario.num_workers, scenario.seed)
+	if scenario.output_file != None:
+		logger.write(scenario.output_file)
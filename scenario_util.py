@@ -7,7 +7,12 @@
 import util as ut
 from scipy import stats
 import math
+import multiprocessing
+import random as rd
+import numpy as np
 from knn import *
+from policy import PolicyTable
+from training_data import TrainingData
 
 #-------------------------- STATISTICAL FUNCTIONS ------------------------
 
@@ -58,6 +63,16 @@ class ScenarioRecorder(object):
 	def set(self, key, val):
 		self.records[key] = val
 	
+	# Merge in the records of another recorder: list values are added
+	# one by one (in order) to this recorder's lists, other values are set.
+	def merge(self, records):
+		for (key, val) in records.items():
+			if type(val) == type([]):
+				for v in val:
+					self.add(key, v)
+			else:
+				self.set(key, val)
+	
 	# Get whatever is corresponding to the key
 	def get(self, key):
 		if self.records.has_key(key):
@@ -80,7 +95,9 @@ class ScenarioRecorder(object):
 		return self.records.keys()
 
 #-------------------------- UTILITY FUNCTIONS ----------------------------		
-# A solver is a function f: user -> msg
+# A solver is a function f: user -> msg. A solver may also carry a batch 
+# form as its 'many' attribute, f.many: [user] -> [msg], which is used instead
+# of calling it once per user.
 # Each element in solvers is a (solver, solver name) pair
 def execute_trial(train_data, test_users, data_gen, solvers, recorder,
 					trial_name = None, measures_per_user = 1,
@@ -96,7 +113,7 @@ def execute_trial(train_data, test_users, data_gen, solvers, recorder,
 	for (f, solver_name) in solvers:
 		logger_f("  Starting solver: " + solver_name, 'standard')
 		start_time = ut.curr_time()
-		msgs = map(f, test_users)
+		msgs = f.many(test_users) if hasattr(f, 'many') else map(f, test_users)
 		elapsed = ut.curr_time() - start_time
 		resps = []
 		for i in range(measures_per_user):
@@ -110,6 +127,42 @@ def execute_trial(train_data, test_users, data_gen, solvers, recorder,
 		logger_f("  Results (correct%, elapsed time): " + str((correct_frac, elapsed)), 'standard')
 		
 
+# Returns a list of num_trials random seeds derived from the base seed, one per trial.
+def trial_seeds(seed, num_trials):
+	gen = rd.Random(seed)
+	return map(lambda t: gen.randint(0, 2**31 - 1), range(num_trials))
+
+# Runs a single trial on its own recorder and logger, after seeding both the 
+# random and numpy.random generators with the trial's seed. Takes one argument,
+# a (trial_initializer_f, trial number, seed) tuple, so it can be mapped over a pool.
+# Returns: (the trial recorder's records, the trial logger's lines, solver names)
+def run_single_trial((trial_initializer_f, t, seed)):
+	rd.seed(seed)
+	np.random.seed(seed)
+	recorder = ScenarioRecorder()
+	logger = BasicLogger()
+	trial_start = ut.curr_time()
+	logger.log('Starting new trial, initializing...', 'standard')
+	train_data, test_users, data_generator, solvers = trial_initializer_f(recorder, logger)
+	logger.log('  Time initializing: ' + str(ut.curr_time() - trial_start) + ' sec.', 'standard')
+	execute_trial(train_data, test_users, data_generator, solvers, recorder, 
+				  trial_name = 'Trial ' + str(t), logger = logger)
+	recorder.add('trial.elapsed_time', ut.curr_time() - trial_start)
+	return (recorder.records, logger.lines, map(lambda (x, y): y, solvers))
+
+# Runs the trials on a pool of the given number of worker processes (in this
+# process if workers is 1), returning their run_single_trial results in trial order.
+def map_trials(trial_initializer_f, seeds, workers = 1):
+	tasks = map(lambda (t, seed): (trial_initializer_f, t, seed), zip(range(1, len(seeds) + 1), seeds))
+	if workers <= 1:
+		return map(run_single_trial, tasks)
+	pool = multiprocessing.Pool(workers)
+	try:
+		return pool.map(run_single_trial, tasks, 1)
+	finally:
+		pool.close()
+		pool.join()
+
 # A trial_initializer_f is a function which takes a recorder and logger as input and returns a tuple:
 # (train_data, test_users, data_generator, [(solver_f, name)])
 # An analyzer_f is a procedure which takes these args (in order):
@@ -117,32 +170,65 @@ def execute_trial(train_data, test_users, data_gen, solvers, recorder,
 #    2) a logger, 
 #    3) a list solver names with the following convention:
 #      Control solvers start with control_ and treatment solvers start with solver_
-def run_trials(trial_initializer_f, analyzer_f, num_trials, recorder, logger):
+# Trials can be spread over a pool of worker processes, in which case trial_initializer_f
+# must be a module-level function. Each trial is seeded from the base seed (a random one 
+# if None), and its records are merged into the recorder in trial order, so the results
+# are the same for any number of workers.
+def run_trials(trial_initializer_f, analyzer_f, num_trials, recorder, logger, 
+			   workers = 1, seed = None):
+	if seed == None:
+		seed = rd.randint(0, 2**31 - 1)
 	recorder.set('num_trials', num_trials)
+	recorder.set('seed', seed)
 	main_start_time = ut.curr_time()
-	for t in range(1, num_trials + 1):
-		trial_start = ut.curr_time()
-		logger.log('Starting new trial, initializing...', 'standard')
-		train_data, test_users, data_generator, solvers = trial_initializer_f(recorder, logger)
-		logger.log('  Time initializing: ' + str(ut.curr_time() - trial_start) + ' sec.', 'standard')
-		execute_trial(train_data, test_users, data_generator, solvers, recorder, 
-					  trial_name = 'Trial ' + str(t), logger = logger)
+	results = map_trials(trial_initializer_f, trial_seeds(seed, num_trials), workers)
+	for (records, lines, solver_names) in results:
+		recorder.merge(records)
+		logger.lines += lines
 	main_elapsed = ut.curr_time() - main_start_time
 	recorder.set('main.elapsed_time', main_elapsed)
-	analyzer_f(recorder, logger, map(lambda (x, y): y, solvers))	
+	analyzer_f(recorder, logger, solver_names)	
 		
-# For a list of test users and test messages, return the n best-performing.
+# For a list of test users and test messages, return the n best-performing
+# (by simulated positive responses over every user/message pair). A message listed
+# more than once is scored by its total over all of its copies.
 # Used for a control case to compare other algorithms to.	
 # **NOTE: param msgs can be either 1) an integer, or 2) a list of pre-made messages
 #         If it is an integer, the specified number of random messages will be generated.
-def n_best_messages(users, data_gen, msgs, n):
+#         It may also be a lazy list such as data_gen.unique_inters(), which is scored 
+#         in chunks of chunk_size messages so that only one chunk is made at a time
+#         (a ut.MixedRadixSpace holds each message once, so its totals are not needed).
+def n_best_messages(users, data_gen, msgs, n, chunk_size = 10000):
 	if type(msgs) == type(0):
 		msgs = data_gen.gen_random_inters(msgs)
-	rows = zip(*data_gen.gen_crossprod_rows(users, msgs))
-	mcount = lambda m: sum(map(lambda x: x[2], filter(lambda y: y[1] == m, rows)))
-	pos_count = lambda y: sum(map(lambda x: x[2], filter(lambda z: y == z[1], tups)))
-	results = map(lambda msg: (msg, mcount(msg)), msgs)
-	return map(lambda (msg, _): msg, ut.top_n(results, n, lambda y: y[1]))
+	counts = np.zeros(len(msgs), dtype = np.int64)
+	for start in xrange(0, len(msgs), chunk_size):
+		chunk = msgs[start:start + chunk_size]
+		counts[start:start + len(chunk)] = data_gen.crossprod_success_counts(users, chunk)
+	if not(isinstance(msgs, ut.MixedRadixSpace)):
+		counts = ut.row_totals(ut.LevelEncoder().fit_encode(msgs), counts)
+	return map(lambda i: msgs[i], ut.top_n_indices(counts, n).tolist())
+	
+# Builds a solver from a KNNOptimizer, k, and attribute selector, with
+# the optimizer's batch entry point attached as the solver's 'many' form.
+# If workers is more than 1, the batch form designs the messages on that
+# many processes (see KNNOptimizer.optimize_parallel).
+def knn_solver(op, k, att_selector_f, workers = 1):
+	f = lambda u: op.optimize(u, k, att_selector_f)
+	if workers > 1:
+		f.many = lambda users: op.optimize_parallel(users, k, att_selector_f, workers)
+	else:
+		f.many = lambda users: op.optimize_many(users, k, att_selector_f)
+	return f
+	
+# Builds a solver which serves the messages of a KNNOptimizer, k, and attribute selector
+# from a PolicyTable (see policy.py) compiled over every profile of the data generator's
+# users on workers processes. Users outside the table are designed live.
+def policy_solver(op, k, att_selector_f, data_gen, workers = 1):
+	table = PolicyTable(op, att_selector_f, data_gen.user_attrs, k).compile(workers)
+	f = lambda u: table.message(u)
+	f.many = table.messages
+	return f
 	
 # Build (solver, name) pairs for each of the 3 standard controls
 # which can go into execute_trial.	
@@ -164,32 +250,63 @@ def build_std_control_solvers(calibration_users, data_gen, msgs = 100, top_n = 1
 				(ctrl_3, 'control_3')]
 	return solvers
 	
+# Builds a KNNOptimizer over the training data, indexed, with the similarity for the
+# KNN solvers of a trial (see build_all_knn_optims and build_std_knn_optims).
+# The similarity is the name of a similarity kernel (see knn.similarity_kernels) 
+# and similarity_args are its arguments, if any. If approximate is a (number of 
+# tables, band size) pair, neighbors are searched in approximate mode (see 
+# KNNOptimizer.set_approximate) and its recall on the calibration users is recorded.
+# **NOTE: train_data can be either 1) a list of (user, msg, response) rows, or 2) a 
+#         TrainingData store already holding them (see Scenario.split_rows).
+def build_knn_optimizer(train_data, calibration_users, recorder, max_k = 15, 
+						similarity = 'match_count', similarity_args = (), approximate = None):
+	op = KNNOptimizer()
+	if isinstance(train_data, TrainingData):
+		op.set_data(train_data, index = True)
+	else:
+		op.set_data_rows(train_data, index = True)
+	op.set_similarity_f(similarity, *similarity_args)
+	if approximate != None:
+		op.set_approximate(*approximate)
+		recorder.add('knn.lsh_recall', op.approximate_recall(calibration_users, max_k)['recall'])
+	return op
+
+# Builds a KNN solver from the optimizer, k, and attribute selector. The test messages
+# are designed on design_workers processes (see knn_solver), or, if policy_table is 
+# True, served from a policy table compiled on them (see policy_solver).
+def build_knn_solver(op, k, att_selector_f, data_gen, design_workers = 1, policy_table = False):
+	if policy_table:
+		return policy_solver(op, k, att_selector_f, data_gen, design_workers)
+	return knn_solver(op, k, att_selector_f, design_workers)
+
 # Builds all KNN solvers in (solver, name) pairs, which can go
 # which can go into execute_trial.	
+# The optimizer is set up by build_knn_optimizer and the solvers built by build_knn_solver.
 def build_all_knn_optims(train_data, calibration_users, data_gen, recorder, 
-						 min_k = 1, max_k = 15):
+						 min_k = 1, max_k = 15, similarity = 'match_count', similarity_args = (),
+						 approximate = None, design_workers = 1, policy_table = False):
 	b = data_gen
-	op = KNNOptimizer()
-	op.set_data_rows(train_data)
-	op.set_similarity_f(match_count)
+	op = build_knn_optimizer(train_data, calibration_users, recorder, max_k, similarity, similarity_args, approximate)
 	asf_1 = build_weighted_mode_selector(lambda x: 1)
 	asf_2 = build_weighted_mode_selector(lambda x: 10**x)
 	asf_3 = build_weighted_max_pos_proportion_selector(lambda x: 1)
 	asf_4 = build_weighted_max_pos_proportion_selector(lambda x: 10**x)
 	response_f = lambda u, m: b.gen_response(u, m)
-	k1 = op.find_best_k(calibration_users, min_k, max_k, asf_1, response_f)
-	k2 = op.find_best_k(calibration_users, min_k, max_k, asf_2, response_f)
-	k3 = op.find_best_k(calibration_users, min_k, max_k, asf_3, response_f)
-	k4 = op.find_best_k(calibration_users, min_k, max_k, asf_4, response_f)
+	k1 = op.find_best_k(calibration_users, min_k, max_k, asf_1, response_f, 'solver_1')
+	k2 = op.find_best_k(calibration_users, min_k, max_k, asf_2, response_f, 'solver_2')
+	k3 = op.find_best_k(calibration_users, min_k, max_k, asf_3, response_f, 'solver_3')
+	k4 = op.find_best_k(calibration_users, min_k, max_k, asf_4, response_f, 'solver_4')
 	recorder.add('solver_1.k', k1)
 	recorder.add('solver_2.k', k2)
 	recorder.add('solver_3.k', k3)
 	recorder.add('solver_4.k', k4)
+	recorder.add('knn.dedup_ratio', op.dedup_stats()['ratio'])
 	print('k1, k2: ' + str((k1, k2)))
-	f_1 = lambda u: op.optimize(u, k1, asf_1)
-	f_2 = lambda u: op.optimize(u, k2, asf_2)
-	f_3 = lambda u: op.optimize(u, k3, asf_3)
-	f_4 = lambda u: op.optimize(u, k4, asf_4)
+	solver = lambda k, asf: build_knn_solver(op, k, asf, b, design_workers, policy_table)
+	f_1 = solver(k1, asf_1)
+	f_2 = solver(k2, asf_2)
+	f_3 = solver(k3, asf_3)
+	f_4 = solver(k4, asf_4)
 	solvers = [(f_1, 'solver_1'),
 			   (f_2, 'solver_2'),
 			   (f_3, 'solver_3'),
@@ -199,22 +316,24 @@ def build_all_knn_optims(train_data, calibration_users, data_gen, recorder,
 
 # Builds standard (mode-based) KNN solvers in (solver, name) pairs, which can go
 # which can go into execute_trial.	
+# The optimizer is set up by build_knn_optimizer and the solvers built by build_knn_solver.
 def build_std_knn_optims(train_data, calibration_users, data_gen, recorder, 
-						 min_k = 1, max_k = 15):
+						 min_k = 1, max_k = 15, similarity = 'match_count', similarity_args = (),
+						 approximate = None, design_workers = 1, policy_table = False):
 	b = data_gen
-	op = KNNOptimizer()
-	op.set_data_rows(train_data)
-	op.set_similarity_f(match_count)
+	op = build_knn_optimizer(train_data, calibration_users, recorder, max_k, similarity, similarity_args, approximate)
 	asf_1 = build_weighted_mode_selector(lambda x: 1)
 	asf_2 = build_weighted_mode_selector(lambda x: 10**x)
 	response_f = lambda u, m: b.gen_response(u, m)
-	k1 = op.find_best_k(calibration_users, min_k, max_k, asf_1, response_f)
-	k2 = op.find_best_k(calibration_users, min_k, max_k, asf_2, response_f)
+	k1 = op.find_best_k(calibration_users, min_k, max_k, asf_1, response_f, 'solver_1')
+	k2 = op.find_best_k(calibration_users, min_k, max_k, asf_2, response_f, 'solver_2')
 	recorder.add('solver_1.k', k1)
 	recorder.add('solver_2.k', k2)
+	recorder.add('knn.dedup_ratio', op.dedup_stats()['ratio'])
 	print('k1, k2: ' + str((k1, k2)))
-	f_1 = lambda u: op.optimize(u, k1, asf_1)
-	f_2 = lambda u: op.optimize(u, k2, asf_2)
+	solver = lambda k, asf: build_knn_solver(op, k, asf, b, design_workers, policy_table)
+	f_1 = solver(k1, asf_1)
+	f_2 = solver(k2, asf_2)
 	solvers = [(f_1, 'solver_1'),
 			   (f_2, 'solver_2')
 			  ]
@@ -231,6 +350,11 @@ def standard_analyzer_f(recdr, logr, solver_names):
 	all = ctrls + tmts
 	log('-------------------- RESULTS ------------------------')
 	log('Number of trials: ', get('num_trials'))
+	log('Seed: ', get('seed'))
+	if get('knn', 'dedup_ratio') != 'NA':
+		log('Avg. training rows per distinct user profile: ', mean(get('knn', 'dedup_ratio')))
+	if get('knn', 'lsh_recall') != 'NA':
+		log('Avg. approximate neighbor recall: ', mean(get('knn', 'lsh_recall')))
 	for s in tmts:
 		log(s + ' avg. k: ', mean(get(s, 'k')))
 	for s in ctrls:
@@ -251,6 +375,7 @@ def standard_analyzer_f(recdr, logr, solver_names):
 	for s in tmts:
 		for c in ctrls:
 			log('Avg ' + s + '/ ' + c + ' ratio: ', max(get(s, 'correct_frac')) / max(get(c, 'correct_frac')))
+	log('-------------------- TOTAL TRIAL TIME: ', sum(get('trial', 'elapsed_time')), ' sec.')
 	log('-------------------- TOTAL ELAPSED TIME: ', get('main', 'elapsed_time'), ' sec.')
 	
 	
@@ -0,0 +1,31 @@
+# --------------------------------------------------------------------------------------
+# About: This file holds the random data used throughout the tests.
+# --------------------------------------------------------------------------------------
+
+import random as rd
+
+# Returns a random user or message: width attribute values, each one of levels levels.
+def random_pattern(gen, width, levels):
+	return map(lambda j: 'L_' + str(gen.randint(1, levels)), range(width))
+
+# Returns n random (user, msg, response) rows drawn from a random.Random with the given
+# seed. Users are drawn from a pool of num_users, so that users repeat.
+def random_rows(seed, n, user_width = 5, msg_width = 3, levels = 3, num_users = 60, pos_prob = 0.3):
+	gen = rd.Random(seed)
+	users = map(lambda i: random_pattern(gen, user_width, levels), range(num_users))
+	return map(lambda i: (list(gen.choice(users)), random_pattern(gen, msg_width, levels), 
+						  int(gen.random() < pos_prob)), range(n))
+
+# The data of rows grouped by user, as the list of (user, [pos msgs], [neg msgs]) tuples
+# the optimizer kept before its data was encoded: users in order of first appearance and 
+# each user's messages in the order of the rows.
+def grouped(rows):
+	keys = []
+	groups = {}
+	for (u, m, r) in rows:
+		key = tuple(u)
+		if not(groups.has_key(key)):
+			keys.append(key)
+			groups[key] = (list(u), [], [])
+		groups[key][1 if r == 1 else 2].append(list(m))
+	return map(lambda key: groups[key], keys)
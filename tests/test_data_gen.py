@@ -0,0 +1,108 @@
+# --------------------------------------------------------------------------------------
+# About: Tests of the simulated data in data_gen.py, checked against the simple
+#        versions they replaced.
+# --------------------------------------------------------------------------------------
+
+import unittest
+import random as rd
+import numpy as np
+import util as ut
+from data_gen import *
+
+# A random categorical DataGenerator with random propensities, one of them matching
+# every pair, drawn from the given seed.
+def random_generator(seed):
+	rd.seed(seed)
+	np.random.seed(seed)
+	b = DataGenerator()
+	b.set_baseline_response_prob(0.05)
+	b.add_random_user_attrs(6, 2, 4)
+	b.add_random_inter_attrs(4, 2, 4)
+	b.set_random_propensities(6, 1, 3, 1, 3, 0.2, 0.8)
+	b.set_propensity({}, 0.1)
+	return b
+
+# The response probability of a pair as originally found: that of the best
+# matching propensity by a linear scan (see ut.best_match), or the baseline.
+def reference_prob(b, user, inter):
+	match = ut.best_match(user + inter, b.propensities, ignore = [None], patlist_accessor = lambda x: x[0])
+	return match[1] if match != None else b.baseline_response_prob
+
+class PropensityMatcherTest(unittest.TestCase):
+	def test_probs_equal_linear_matcher(self):
+		for seed in range(5):
+			b = random_generator(seed)
+			users, inters = b.gen_random_users(60), b.gen_random_inters(25)
+			m = b.get_matcher()
+			pairs = map(lambda n: (users[n % len(users)], inters[n % len(inters)]), range(300))
+			expected = map(lambda (u, i): reference_prob(b, u, i), pairs)
+			self.assertEqual(map(lambda (u, i): m.response_prob(u + i), pairs), expected)
+			self.assertEqual(m.response_probs(map(lambda p: p[0], pairs), map(lambda p: p[1], pairs)).tolist(), expected)
+			probs = m.pair_probs(m.encode_side(users, True), m.encode_side(inters, False))
+			self.assertEqual(probs.tolist(), map(lambda u: map(lambda i: reference_prob(b, u, i), inters), users))
+	
+	def test_single_response_draws_as_before(self):
+		b = random_generator(7)
+		users, inters = b.gen_random_users(40), b.gen_random_inters(40)
+		rd.seed(1)
+		a = map(lambda (u, i): b.gen_response(u, i), zip(users, inters))
+		rd.seed(1)
+		expected = map(lambda (u, i): 1 if rd.uniform(0, 1) <= reference_prob(b, u, i) else 0, zip(users, inters))
+		self.assertEqual(a, expected)
+	
+	def test_coded_responses_equal_responses(self):
+		b = random_generator(8)
+		users, inters = b.gen_random_users(500), b.gen_random_inters(500)
+		np.random.seed(2)
+		a = b.gen_responses(users, inters)
+		np.random.seed(2)
+		c = b.gen_coded_responses(b.encode_entities(users, b.user_attrs), b.encode_entities(inters, b.inter_attrs))
+		self.assertEqual(a, c.tolist())
+
+class EntityGenerationTest(unittest.TestCase):
+	def setUp(self):
+		self.b = DataGenerator()
+		self.attrs = [('a', ['x', 'y']), ('b', ['p', 'q', 'r']), ('c', [0, 1, 2]), ('d', (2.5, 4.0))]
+		self.templates = [({'a': 'x'}, 3), ({'b': 'q', 'c': 1}, 2), ({'c': 'unseen'}, 1)]
+	
+	def test_entities_match_no_excluded_template(self):
+		for seed in range(5):
+			entities = self.b.gen_random_entities(self.attrs, 300, self.templates, seed)
+			self.assertEqual(len(entities), 300)
+			start = 0
+			for (template, num_reps) in self.templates:
+				for e in entities[start:start + num_reps]:
+					self.assertTrue(self.b.matches_template(template, self.attrs, e))
+				start += num_reps
+			for e in entities[start:]:
+				for (template, num_reps) in self.templates:
+					self.assertFalse(self.b.matches_template(template, self.attrs, e))
+			self.assertEqual(set(map(lambda e: e[0], entities[start:])), set(['y']))
+	
+	def test_template_mask_equals_matches_template(self):
+		cols = self.b.sample_entity_columns(self.attrs, 200, [], np.random.RandomState(3))
+		entities = self.b.zip_columns(self.b.entity_values(self.attrs, cols), 200)
+		templates = map(lambda (t, r): t, self.templates) + [{'d': entities[0][3]}, {'a': 'y', 'b': 'r', 'c': 2}]
+		for t in templates:
+			self.assertEqual(self.b.template_mask(cols, self.attrs, 200, [t]).tolist(), 
+							 map(lambda e: self.b.matches_template(t, self.attrs, e), entities))
+		self.assertEqual(self.b.template_mask(cols, self.attrs, 200, templates).tolist(), 
+						 map(lambda e: any(map(lambda t: self.b.matches_template(t, self.attrs, e), templates)), entities))
+	
+	def test_seed_reproduces_entities(self):
+		a = self.b.gen_random_entities(self.attrs, 100, self.templates, 11)
+		self.assertEqual(a, self.b.gen_random_entities(self.attrs, 100, self.templates, 11))
+		self.assertNotEqual(a, self.b.gen_random_entities(self.attrs, 100, self.templates, 12))
+		np.random.seed(13)
+		a = self.b.gen_random_entities(self.attrs, 100, self.templates)
+		np.random.seed(13)
+		self.assertEqual(a, self.b.gen_random_entities(self.attrs, 100, self.templates))
+	
+	def test_continuous_values_within_bounds(self):
+		values = map(lambda e: e[3], self.b.gen_random_entities(self.attrs, 500, self.templates, 14))
+		self.assertTrue(all(map(lambda v: 2.5 <= v < 4.0, values)))
+		self.assertTrue(all(map(lambda e: e[1] in ['p', 'q', 'r'] and e[2] in [0, 1, 2], 
+								self.b.gen_random_entities(self.attrs, 500, [], 15))))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,358 @@
+# --------------------------------------------------------------------------------------
+# About: Tests of the nearest-neighbor optimizer in knn.py, checked against simple
+#        reference computations over the decoded data.
+# --------------------------------------------------------------------------------------
+
+import os
+import unittest
+import shutil
+import tempfile
+import numpy as np
+import util as ut
+from knn import *
+from tests.helpers import random_rows, grouped
+
+# The neighbors of the user as the original optimizer found them: data rows sorted by
+# decreasing similarity, equally similar rows in data order.
+def reference_nearest(data, user, k, similarity_f):
+	sims = map(lambda (u, pos, neg): similarity_f(user, u), data)
+	order = sorted(range(len(data)), key = lambda i: -sims[i])[:k]
+	return (order, map(lambda i: sims[i], order))
+
+class EncodedMatchCountTest(unittest.TestCase):
+	def setUp(self):
+		self.rows = random_rows(1, 400)
+		self.queries = map(lambda (u, m, r): u, random_rows(2, 40)) + [['x', 'L_1', 'L_2', 'y', 'L_3']]
+	
+	def test_kernel_counts_equal_match_count(self):
+		op = KNNOptimizer()
+		op.set_data_rows(self.rows)
+		op.set_similarity_f('match_count')
+		for q in self.queries:
+			expected = map(lambda u: match_count(q, u), op.store.decoded_users())
+			self.assertEqual(op.similarities(q).tolist(), expected)
+	
+	def test_nearest_equals_reference(self):
+		data = grouped(self.rows)
+		for index in [False, True]:
+			op = KNNOptimizer()
+			op.set_data_rows(self.rows, index = index)
+			op.set_similarity_f(match_count)
+			for q in self.queries:
+				inds, sims = op.nearest(q, 7)
+				self.assertEqual((inds.tolist(), sims.tolist()), reference_nearest(data, q, 7, match_count))
+	
+	def test_designs_equal_plain_function(self):
+		sel = build_weighted_mode_selector(lambda x: 10**x)
+		encoded, plain = KNNOptimizer(), KNNOptimizer()
+		for op in [encoded, plain]:
+			op.set_data_rows(self.rows, index = True)
+		encoded.set_similarity_f(match_count)
+		plain.set_similarity_f(lambda u, v: match_count(u, v))
+		rd.seed(3)
+		a = map(lambda q: encoded.optimize(q, 5, sel), self.queries)
+		rd.seed(3)
+		b = map(lambda q: plain.optimize(q, 5, sel), self.queries)
+		self.assertEqual(a, b)
+
+# The selector without its tally and kernel, so that it is run on the parsed neighbors.
+def plain_selector(sel):
+	return lambda pos, neg: sel(pos, neg)
+
+class SelectorTallyTest(unittest.TestCase):
+	def setUp(self):
+		self.rows = random_rows(5, 300, pos_prob = 0.15)
+		self.users = map(lambda (u, m, r): u, random_rows(6, 30))
+		self.selectors = [build_weighted_mode_selector(lambda x: 1), build_weighted_mode_selector(lambda x: 10**x),
+						  build_weighted_max_pos_proportion_selector(lambda x: 1),
+						  build_weighted_max_pos_proportion_selector(lambda x: 10**x)]
+	
+	def optimizer(self):
+		op = KNNOptimizer()
+		op.set_data_rows(self.rows)
+		op.set_similarity_f('match_count')
+		return op
+	
+	def test_k_range_equals_per_k_loop(self):
+		for sel in self.selectors:
+			tallied, looped = self.optimizer(), self.optimizer()
+			plain = plain_selector(sel)
+			for u in self.users:
+				rd.seed(7)
+				a = tallied.optimize_k_range(u, 1, 12, sel)
+				rd.seed(7)
+				b = map(lambda k: looped.optimize(u, k, plain), range(1, 13))
+				self.assertEqual(a, b)
+	
+	def test_kernel_designs_equal_plain_selector(self):
+		for sel in self.selectors:
+			kernel, plain = self.optimizer(), self.optimizer()
+			for k in [1, 4, 15]:
+				rd.seed(8)
+				a = map(lambda u: kernel.optimize(u, k, sel), self.users)
+				rd.seed(8)
+				b = map(lambda u: plain.optimize(u, k, plain_selector(sel)), self.users)
+				self.assertEqual(a, b)
+	
+	def test_find_best_k_equals_per_k_loop(self):
+		response_f = lambda u, m: int(match_count(u[:3], m) >= 2)
+		for sel in self.selectors:
+			rd.seed(9)
+			a = self.optimizer().find_best_k(self.users, 1, 10, sel, response_f)
+			rd.seed(9)
+			b = self.optimizer().find_best_k(self.users, 1, 10, plain_selector(sel), response_f)
+			self.assertEqual(a, b)
+
+class DataOrderTest(unittest.TestCase):
+	def test_users_in_order_of_first_appearance(self):
+		rows = [(['a'], ['x'], 1), (['b'], ['y'], 0), (['a'], ['y'], 0), (['a'], ['z'], 1), (['c'], ['x'], 1), (['b'], ['z'], 1)]
+		op = KNNOptimizer()
+		op.set_data_rows(rows)
+		self.assertEqual(op.data, [(['a'], [['x'], ['z']], [['y']]), (['b'], [['z']], [['y']]), (['c'], [['x']], [])])
+	
+	def test_random_rows_in_order_of_first_appearance(self):
+		rows = random_rows(11, 500)
+		firsts = []
+		for (u, m, r) in rows:
+			if not(u in firsts):
+				firsts.append(u)
+		op = KNNOptimizer()
+		op.set_data_rows(rows)
+		op.set_similarity_f('match_count')
+		self.assertEqual(map(lambda (u, pos, neg): u, op.data), firsts)
+		op.optimize(rows[0][0], 5, build_weighted_mode_selector())
+		self.assertEqual(map(lambda (u, pos, neg): u, op.data), firsts)
+
+# The (user, msg, response) rows of the grouped data, user by user in data order.
+def replay(data):
+	return reduce(lambda w, (u, pos, neg): w + map(lambda m: (u, m, 1), pos) + map(lambda m: (u, m, 0), neg), data, [])
+
+class IncrementalDataTest(unittest.TestCase):
+	def optimizer(self, rows, similarity, index):
+		op = KNNOptimizer()
+		op.set_data_rows(rows, index = index)
+		op.set_similarity_f(similarity)
+		return op
+	
+	def assert_same_search(self, op, fresh, queries, sel):
+		for q in queries:
+			a, b = op.neighbors(q, 8), fresh.neighbors(q, 8)
+			self.assertEqual((a.inds[:8].tolist(), a.sims[:8]), (b.inds[:8].tolist(), b.sims[:8]))
+			rd.seed(12)
+			a = op.optimize_k_range(q, 1, 8, sel)
+			rd.seed(12)
+			self.assertEqual(a, fresh.optimize_k_range(q, 1, 8, sel))
+	
+	def test_added_rows_equal_rebuild(self):
+		rows = random_rows(13, 600, num_users = 120)
+		for similarity in ['match_count', 'jaccard', lambda u, v: match_count(u, v)]:
+			op = self.optimizer(rows[:100], similarity, True)
+			for end in range(150, 601, 50):
+				op.neighbor_depth = 8
+				map(lambda (u, m, r): op.neighbors(u, 8), rows[:40])
+				op.add_data_rows(rows[end - 50:end])
+				self.assertEqual(op.data, grouped(rows[:end]))
+				self.assert_same_search(op, self.optimizer(rows[:end], similarity, True), 
+										map(lambda (u, m, r): u, rows[:40]), build_weighted_mode_selector())
+	
+	def test_added_exact_match_found_by_similarity_function(self):
+		similarity = lambda u, v: 10 if u == v else 1
+		user = [0, 1, 2]
+		op = self.optimizer([([9, 9, 9], ['m1'], 1), ([8, 8, 8], ['m2'], 0)], similarity, False)
+		self.assertEqual(op.neighbors(user, 1).sims, [1])
+		op.add_data_rows([(user, ['m9'], 1)])
+		fresh = self.optimizer(replay(op.data), similarity, False)
+		self.assertEqual(op.neighbors(user, 1).inds.tolist(), fresh.neighbors(user, 1).inds.tolist())
+		self.assertEqual(op.neighbors(user, 1).sims, [10])
+		self.assertEqual(op.optimize(user, 1, build_weighted_mode_selector()), ['m9'])
+	
+	def test_random_add_and_retire_equal_rebuild(self):
+		gen = rd.Random(14)
+		pool = random_rows(15, 800, num_users = 150)
+		queries = map(lambda (u, m, r): u, random_rows(16, 30, num_users = 150))
+		sel = build_weighted_max_pos_proportion_selector(lambda x: 10**x)
+		for (similarity, index) in [('match_count', True), ('match_count', False), ('gower', False)]:
+			held = list(pool[:200])
+			op = self.optimizer(held, similarity, index)
+			for step in range(12):
+				op.neighbor_depth = 8
+				map(lambda q: op.neighbors(q, 8), queries)
+				if gen.random() < 0.5:
+					added = gen.sample(pool, 40)
+					op.add_data_rows(added)
+					held += added
+				else:
+					retired = gen.sample(held, 40)
+					op.retire_data_rows(retired)
+					for row in retired:
+						held.remove(row)
+				self.assertEqual(sorted(replay(op.data)), sorted(map(lambda (u, m, r): (list(u), list(m), r), held)))
+				self.assert_same_search(op, self.optimizer(replay(op.data), similarity, index), queries, sel)
+
+class TiledDesignTest(unittest.TestCase):
+	def setUp(self):
+		self.rows = random_rows(31, 400)
+		self.users = map(lambda (u, m, r): u, random_rows(32, 50))
+	
+	def optimizer(self, similarity, *args):
+		op = KNNOptimizer()
+		op.set_data_rows(self.rows)
+		op.set_similarity_f(similarity, *args)
+		return op
+	
+	def test_tiles_sized_by_kernel_working_memory(self):
+		budget = 2**20
+		for (name, args) in [('match_count', ()), ('weighted_match', ([1, 2, 1, 1, 1],)), ('jaccard', ()), ('gower', ())]:
+			op = self.optimizer(name, *args)
+			self.assertEqual(op.tile_size(budget), budget / (op.kernel.work_bytes * len(op.store)))
+		self.assertTrue(self.optimizer('gower').tile_size(budget) < self.optimizer('match_count').tile_size(budget))
+		self.assertEqual(self.optimizer(lambda u, v: 1).tile_size(1), 1)
+	
+	def test_tiled_designs_equal_single_designs(self):
+		sel = build_weighted_mode_selector(lambda x: 10**x)
+		for (name, args) in [('match_count', ()), ('weighted_match', ([1, 2, 1, 1, 1],)), ('jaccard', ()), ('gower', ())]:
+			rd.seed(33)
+			a = self.optimizer(name, *args).optimize_many(self.users, 6, sel, max_bytes = 2**12)
+			rd.seed(33)
+			op = self.optimizer(name, *args)
+			self.assertEqual(a, map(lambda u: op.optimize(u, 6, sel), self.users))
+
+class CacheAccountingTest(unittest.TestCase):
+	def assert_accounted(self, op, max_bytes):
+		self.assertEqual(op.cache.num_bytes, sum(map(ut.approx_size, op.cache.h.values())))
+		self.assertTrue(op.cache.num_bytes <= max_bytes)
+	
+	def test_memoized_designs_count_in_cache_bytes(self):
+		rows = random_rows(41, 300)
+		users = map(lambda (u, m, r): u, random_rows(42, 20))
+		sel = build_weighted_mode_selector(lambda x: 10**x)
+		op = KNNOptimizer(cache_bytes = 2**14)
+		op.set_data_rows(rows)
+		op.set_similarity_f('match_count')
+		for u in users:
+			op.neighbors(u, 10)
+		before = op.cache.num_bytes
+		for k in range(1, 8):
+			for u in users:
+				op.optimize(u, k, sel)
+				self.assert_accounted(op, 2**14)
+			op.optimize_many(users, k + 1, sel)
+			self.assert_accounted(op, 2**14)
+		op.optimize_k_range(users[0], 1, 10, sel)
+		self.assert_accounted(op, 2**14)
+		self.assertTrue(op.cache.evictions > 0 or op.cache.num_bytes > before)
+
+class SaveLoadTest(unittest.TestCase):
+	def setUp(self):
+		self.rows = random_rows(51, 400)
+		self.users = map(lambda (u, m, r): u, random_rows(52, 40))
+		self.sel = build_weighted_mode_selector(lambda x: 10**x)
+		self.directory = tempfile.mkdtemp()
+	
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+	
+	def saved(self, similarity, args = (), index = False, lsh_spec = None):
+		op = KNNOptimizer()
+		if lsh_spec != None:
+			op.set_approximate(*lsh_spec)
+		op.set_data_rows(self.rows, index = index)
+		op.set_similarity_f(similarity, *args)
+		op.best_ks['calibrated'] = 7
+		op.save(self.directory)
+		return op
+	
+	def assert_same_optimizer(self, op, loaded):
+		self.assertEqual(loaded.data, op.data)
+		self.assertEqual(loaded.best_ks, op.best_ks)
+		self.assertEqual(loaded.lsh_spec, op.lsh_spec)
+		self.assertEqual(loaded.index != None, op.index != None)
+		for u in self.users:
+			a, b = op.nearest(u, 9), loaded.nearest(u, 9)
+			self.assertEqual(a[0].tolist(), b[0].tolist())
+			self.assertEqual(a[1].tolist(), b[1].tolist())
+		self.assertEqual(loaded.optimize_many(self.users, 9, self.sel, fallback = False),
+						 op.optimize_many(self.users, 9, self.sel, fallback = False))
+	
+	def test_save_and_load_round_trip(self):
+		for (similarity, args, index, lsh_spec) in [('match_count', (), False, None), ('match_count', (), True, None),
+													('weighted_match', ([1, 2, 1, 1, 1],), False, None),
+													('jaccard', (), True, None), ('gower', (), False, None),
+													('match_count', (), False, (4, 2, 53))]:
+			op = self.saved(similarity, args, index, lsh_spec)
+			self.assert_same_optimizer(op, KNNOptimizer().load(self.directory))
+			self.assert_same_optimizer(op, KNNOptimizer().load(self.directory, mmap_mode = None))
+	
+	def test_loaded_similarity_function_set_again(self):
+		similarity_f = lambda u, v: match_count(u, v) + (u[0] == v[0])
+		op = self.saved(similarity_f)
+		loaded = KNNOptimizer().load(self.directory)
+		self.assertEqual(loaded.similarity, None)
+		loaded.set_similarity_f(similarity_f)
+		self.assert_same_optimizer(op, loaded)
+	
+	def test_parallel_designs_equal_optimize_many(self):
+		op = self.saved('match_count')
+		a = op.optimize_parallel(self.users, 9, self.sel, workers = 2, block_size = 16, seed = 54)
+		self.assertEqual(a, op.optimize_parallel(self.users, 9, self.sel, workers = 1, block_size = 16, seed = 54))
+		for (m, d) in zip(a, op.optimize_many(self.users, 9, self.sel, fallback = False)):
+			if d != None:
+				self.assertEqual(m, d)
+
+class ShardTest(unittest.TestCase):
+	def setUp(self):
+		self.rows = random_rows(61, 400)
+		self.users = map(lambda (u, m, r): u, random_rows(62, 40))
+		self.sel = build_weighted_mode_selector(lambda x: 10**x)
+	
+	def optimizer(self, similarity, index = False):
+		op = KNNOptimizer()
+		op.set_data_rows(self.rows, index = index)
+		op.set_similarity_f(similarity)
+		return op
+	
+	def assert_closed(self, op, directory, processes):
+		self.assertEqual(op.shards, [])
+		self.assertFalse(os.path.exists(directory))
+		self.assertFalse(any(map(lambda p: p.is_alive(), processes)))
+		self.assertFalse(open_shards.has_key(directory))
+	
+	def test_sharded_search_equals_unsharded(self):
+		for (similarity, index) in [('match_count', False), ('match_count', True), ('gower', False),
+									(lambda u, v: match_count(u, v) + (u[0] == v[0]), False)]:
+			op, sharded = self.optimizer(similarity, index), self.optimizer(similarity, index)
+			sharded.set_shards(3)
+			try:
+				for u in self.users:
+					a, b = op.nearest(u, 9), sharded.nearest(u, 9)
+					self.assertEqual(a[0].tolist(), b[0].tolist())
+					self.assertEqual(a[1].tolist(), b[1].tolist())
+				self.assertEqual(sharded.optimize_many(self.users, 9, self.sel, fallback = False),
+								 op.optimize_many(self.users, 9, self.sel, fallback = False))
+			finally:
+				sharded.close_shards()
+	
+	def test_close_shards_stops_workers_and_removes_data(self):
+		op = self.optimizer('match_count')
+		op.set_shards(2)
+		directory, processes = op.shard_directory, map(lambda (p, conn, lo): p, op.shards)
+		self.assertTrue(os.path.isdir(directory))
+		op.close_shards()
+		self.assert_closed(op, directory, processes)
+		op.close_shards()
+		self.assert_closed(op, directory, processes)
+	
+	def test_open_shards_closed_at_exit(self):
+		op = self.optimizer('match_count')
+		op.set_shards(2)
+		directory, processes = op.shard_directory, map(lambda (p, conn, lo): p, op.shards)
+		processes[0].terminate()
+		processes[0].join()
+		close_open_shards()
+		self.assertFalse(os.path.exists(directory))
+		self.assertFalse(any(map(lambda p: p.is_alive(), processes)))
+		op.close_shards()
+		self.assert_closed(op, directory, processes)
+
+if __name__ == '__main__':
+	unittest.main()
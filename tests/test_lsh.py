@@ -0,0 +1,71 @@
+# --------------------------------------------------------------------------------------
+# About: Tests of the MinHash index in lsh.py and of the optimizer's approximate mode,
+#        checked against exact search and against rebuilt indexes.
+# --------------------------------------------------------------------------------------
+
+import unittest
+import numpy as np
+from lsh import MinHashIndex
+from knn import *
+from tests.helpers import random_rows
+
+class ApproximateModeTest(unittest.TestCase):
+	def setUp(self):
+		self.rows = random_rows(81, 400, num_users = 150)
+		self.users = map(lambda (u, m, r): u, random_rows(82, 30, num_users = 150))
+	
+	def optimizer(self, rows, lsh_spec = None):
+		op = KNNOptimizer()
+		if lsh_spec != None:
+			op.set_approximate(*lsh_spec)
+		op.set_data_rows(rows)
+		op.set_similarity_f('match_count')
+		return op
+	
+	def assert_same_index(self, a, b):
+		self.assertEqual(a.size, b.size)
+		for (h, g) in zip(a.tables, b.tables):
+			self.assertEqual(sorted(h.keys()), sorted(g.keys()))
+			for key in h.keys():
+				self.assertEqual(h[key].tolist(), g[key].tolist())
+	
+	def test_enough_bands_find_exact_neighbors(self):
+		op = self.optimizer(self.rows, (64, 1, 83))
+		for u in self.users:
+			a, b = op.nearest(u, 5), op.nearest_exact(u, 5)
+			self.assertEqual((a[0].tolist(), a[1].tolist()), (b[0].tolist(), b[1].tolist()))
+		self.assertEqual(op.approximate_recall(self.users, 5)['recall'], 1.0)
+	
+	def test_recall_below_one_when_neighbors_missed(self):
+		op = self.optimizer(self.rows, (1, 4, 84))
+		recall = op.approximate_recall(self.users, 5)['recall']
+		self.assertTrue(0.0 <= recall < 1.0)
+	
+	def test_candidates_of_indexed_rows_include_them(self):
+		op = self.optimizer(self.rows, (4, 3, 85))
+		for i in range(len(op.store)):
+			self.assertTrue(i in op.lsh.candidates(op.store.users[i]).tolist())
+	
+	def test_added_and_retired_rows_equal_seeded_rebuild(self):
+		op = self.optimizer(self.rows[:150], (8, 2, 86))
+		steps = [('add', self.rows[150:250]), ('retire', self.rows[20:90]), ('add', self.rows[250:400]),
+				 ('retire', self.rows[100:200] + self.rows[:20])]
+		for (action, rows) in steps:
+			if action == 'add':
+				op.add_data_rows(rows)
+			else:
+				op.retire_data_rows(rows)
+			rebuilt = MinHashIndex(op.store.users, 8, 2, 86)
+			self.assert_same_index(op.lsh, rebuilt)
+			fresh = KNNOptimizer()
+			fresh.set_approximate(8, 2, 86)
+			fresh.set_data(op.store)
+			fresh.set_similarity_f('match_count')
+			for u in self.users:
+				self.assertEqual(op.lsh.candidates(op.store.user_encoder.encode_row(u)).tolist(),
+								 rebuilt.candidates(op.store.user_encoder.encode_row(u)).tolist())
+				a, b = op.nearest(u, 5), fresh.nearest(u, 5)
+				self.assertEqual((a[0].tolist(), a[1].tolist()), (b[0].tolist(), b[1].tolist()))
+
+if __name__ == '__main__':
+	unittest.main()
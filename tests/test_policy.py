@@ -0,0 +1,82 @@
+# --------------------------------------------------------------------------------------
+# About: Tests of the policy table in policy.py, checked against designing each
+#        profile's message with the optimizer.
+# --------------------------------------------------------------------------------------
+
+import unittest
+import shutil
+import tempfile
+import random as rd
+import numpy as np
+from data_gen import DataGenerator
+from knn import *
+from policy import PolicyTable
+
+class PolicyTableTest(unittest.TestCase):
+	def setUp(self):
+		rd.seed(71)
+		np.random.seed(71)
+		self.b = DataGenerator()
+		self.b.add_random_user_attrs(4, 2, 3)
+		self.b.add_random_inter_attrs(3, 2, 4)
+		self.b.set_random_propensities(3, 1, 2, 1, 2, 0.2, 0.8)
+		user_codes, inter_codes, resps = self.b.gen_row_blocks(300, self.b.gen_random_inters(20)).next()
+		self.op = KNNOptimizer()
+		self.op.set_data_rows(zip(self.b.decode_entities(user_codes, self.b.user_attrs),
+								  self.b.decode_entities(inter_codes, self.b.inter_attrs), resps.tolist()))
+		self.op.set_similarity_f('match_count')
+		self.sel = build_weighted_mode_selector(lambda x: 10**x)
+		self.directory = tempfile.mkdtemp()
+	
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+	
+	def table(self, workers = 1):
+		return PolicyTable(self.op, self.sel, self.b.user_attrs, 5).compile(workers, batch_size = 16)
+	
+	def assert_same_designs(self, table, profiles):
+		designs = self.op.optimize_many(profiles, 5, self.sel, fallback = False)
+		self.assertEqual(table.designed.tolist(), map(lambda d: d != None, designs))
+		for (i, d) in enumerate(designs):
+			if d != None:
+				self.assertEqual(table.msg_encoder.decode_row(table.codes[i]), d)
+				self.assertEqual(table.message(profiles[i]), d)
+	
+	def test_table_equals_optimizer_designs(self):
+		table = self.table()
+		profiles = list(table.space)
+		self.assertEqual(len(table.codes), len(profiles))
+		self.assert_same_designs(table, profiles)
+		self.assertEqual(self.table(2).codes.tolist(), table.codes.tolist())
+		rd.seed(72)
+		a = table.messages(profiles)
+		rd.seed(72)
+		self.assertEqual(a, map(table.message, profiles))
+	
+	def test_users_outside_table_designed_live(self):
+		table = self.table()
+		users = [['unseen'] + list(table.space[0][1:]), list(table.space[1][:-1]) + [None]]
+		for u in users:
+			self.assertEqual(table.profile_code(u), None)
+		rd.seed(73)
+		a = table.messages(users)
+		rd.seed(73)
+		self.assertEqual(a, map(lambda u: self.op.optimize(u, 5, self.sel), users))
+	
+	def test_save_before_compile_raises(self):
+		table = PolicyTable(self.op, self.sel, self.b.user_attrs, 5)
+		self.assertRaises(ValueError, lambda: table.save(self.directory))
+	
+	def test_save_and_load_round_trip(self):
+		table = self.table()
+		table.save(self.directory)
+		loaded = PolicyTable(self.op, self.sel).load(self.directory)
+		self.assertEqual(loaded.k, table.k)
+		self.assertEqual(loaded.user_attrs, table.user_attrs)
+		self.assertEqual(loaded.msg_encoder.levels, table.msg_encoder.levels)
+		self.assertEqual(loaded.codes.tolist(), table.codes.tolist())
+		self.assertEqual(loaded.stats(), table.stats())
+		self.assert_same_designs(loaded, list(loaded.space))
+
+if __name__ == '__main__':
+	unittest.main()
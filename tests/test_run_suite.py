@@ -0,0 +1,66 @@
+# --------------------------------------------------------------------------------------
+# About: Tests of the scenario scheduling in run_suite.py.
+# --------------------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import unittest
+import util as ut
+import run_suite as rs
+from scenario_runner import Scenario
+
+# A results file as written by su.standard_analyzer_f, with the given trial count and
+# total time lines.
+def results_text(num_trials, time_lines):
+	return '\n'.join(['-------------------- RESULTS ------------------------',
+					  'Number of trials:  ' + str(num_trials),
+					  'solver_1 avg. k:  6.8',
+					  'Avg solver_1/ control_1 ratio:  1.46666666667'] + time_lines)
+
+class ScheduleTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+	
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+	
+	# Writes a params file for a scenario whose output file holds the given results text 
+	# (or does not exist if results is None), and returns the scenario.
+	def scenario(self, name, results, output_file = True):
+		path = os.path.join(self.directory, name)
+		lines = ['num_trials,2']
+		if output_file:
+			lines.append('output_file, ' + path + '.txt')
+		ut.write_file('\n'.join(lines), path + '.csv')
+		if results != None:
+			ut.write_file(results, path + '.txt')
+		return Scenario(path + '.csv')
+	
+	def test_estimates_from_past_results(self):
+		elapsed = self.scenario('elapsed', results_text(20, ['-------------------- TOTAL ELAPSED TIME:  6919  sec.']))
+		self.assertAlmostEqual(rs.estimated_trial_time(elapsed), 6919 / 20.0)
+		both = self.scenario('both', results_text(4, ['-------------------- TOTAL TRIAL TIME:  10.5  sec.',
+													  '-------------------- TOTAL ELAPSED TIME:  30  sec.']))
+		self.assertAlmostEqual(rs.estimated_trial_time(both), 10.5 / 4)
+		self.assertEqual(rs.estimated_trial_time(self.scenario('missing', None)), None)
+		self.assertEqual(rs.estimated_trial_time(self.scenario('no_output', None, False)), None)
+		self.assertEqual(rs.estimated_trial_time(self.scenario('no_time', results_text(5, []))), None)
+		self.assertEqual(rs.estimated_trial_time(self.scenario('no_trials', results_text(0, ['TOTAL ELAPSED TIME:  9']))), None)
+	
+	def test_longest_first_with_unknown_first(self):
+		times = [('short', 20, 40), ('long', 2, 900), ('middle', 10, 300)]
+		known = map(lambda (name, trials, total): self.scenario(name, results_text(trials, 
+					['-------------------- TOTAL ELAPSED TIME:  ' + str(total) + '  sec.'])), times)
+		unknown = [self.scenario('new', None), self.scenario('unrun', None, False)]
+		order = rs.schedule(known[:2] + unknown[:1] + known[2:] + unknown[1:])
+		self.assertEqual(map(lambda s: os.path.basename(s.params_file), order),
+						 ['new.csv', 'unrun.csv', 'long.csv', 'middle.csv', 'short.csv'])
+	
+	def test_no_history_keeps_given_order(self):
+		scenarios = map(lambda name: self.scenario(name, None), ['c', 'a', 'b'])
+		self.assertEqual(rs.schedule(scenarios), scenarios)
+		self.assertEqual(rs.schedule([]), [])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,114 @@
+# --------------------------------------------------------------------------------------
+# About: Tests of the scenario helpers in scenario_util.py.
+# --------------------------------------------------------------------------------------
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import random as rd
+import numpy as np
+from StringIO import StringIO
+import util as ut
+import scenario_util as su
+from scenario_runner import Scenario
+from tests.test_data_gen import random_generator
+
+# The original n_best_messages: every user/message pair's response is simulated, and
+# each listed message is scored by the responses of all rows with an equal message.
+def reference_n_best_messages(users, data_gen, msgs, n):
+	rows = zip(*data_gen.gen_crossprod_rows(users, msgs))
+	mcount = lambda m: sum(map(lambda x: x[2], filter(lambda y: y[1] == m, rows)))
+	results = map(lambda msg: (msg, mcount(msg)), msgs)
+	return map(lambda (msg, _): msg, ut.top_n(results, n, lambda y: y[1]))
+
+class NBestMessagesTest(unittest.TestCase):
+	def test_equals_original_with_duplicate_messages(self):
+		for seed in range(4):
+			b = random_generator(seed)
+			users, msgs = b.gen_random_users(80), b.gen_random_inters(30)
+			msgs = msgs + msgs[3:9] + msgs[:2]
+			for n in [1, 5, 15, 40]:
+				np.random.seed(seed)
+				expected = reference_n_best_messages(users, b, msgs, n)
+				np.random.seed(seed)
+				self.assertEqual(su.n_best_messages(users, b, msgs, n), expected)
+	
+	def test_space_in_chunks_equals_list(self):
+		b = random_generator(5)
+		users, space = b.gen_random_users(50), b.unique_inters()
+		np.random.seed(3)
+		counts = b.crossprod_success_counts(users, list(space))
+		expected = map(lambda i: space[i], ut.top_n_indices(counts, 10).tolist())
+		np.random.seed(3)
+		self.assertEqual(su.n_best_messages(users, b, space, 10, chunk_size = len(space)), expected)
+		self.assertEqual(len(su.n_best_messages(users, b, space, 10, chunk_size = 7)), 10)
+
+# A small trial for run_trials: records the first draws of the random and numpy 
+# generators, so the trial's seed can be checked, then runs two controls.
+def draw_trial(recorder, logger):
+	recorder.add('trial.draws', (rd.random(), float(np.random.uniform())))
+	b = random_generator(rd.randint(0, 1000))
+	users, msgs = b.gen_random_users(40), b.gen_random_inters(6)
+	solvers = [(lambda u: rd.sample(msgs, 1)[0], 'control_1'), (lambda u: msgs[0], 'control_2')]
+	return ([], users, b, solvers)
+
+# Runs f() with standard output discarded, as the trials log to it.
+def quietly(f):
+	stdout = sys.stdout
+	sys.stdout = StringIO()
+	try:
+		return f()
+	finally:
+		sys.stdout = stdout
+
+# The records of a recorder without the timings, which vary from run to run.
+def untimed(recorder):
+	return dict(filter(lambda (key, val): not(key.endswith('elapsed_time')), recorder.records.items()))
+
+class RunTrialsTest(unittest.TestCase):
+	def run_trials(self, trial_initializer_f, workers, num_trials = 4, seed = 91):
+		recorder = su.ScenarioRecorder()
+		quietly(lambda: su.run_trials(trial_initializer_f, lambda recdr, logr, names: None, num_trials, 
+									  recorder, su.BasicLogger(), workers, seed))
+		return recorder
+	
+	def test_trials_seeded_from_derived_seeds_in_order(self):
+		seeds = su.trial_seeds(91, 4)
+		self.assertEqual(seeds, su.trial_seeds(91, 4))
+		self.assertEqual(len(set(seeds)), 4)
+		expected = []
+		for seed in seeds:
+			rd.seed(seed)
+			np.random.seed(seed)
+			expected.append((rd.random(), float(np.random.uniform())))
+		for workers in [1, 2]:
+			recorder = self.run_trials(draw_trial, workers)
+			self.assertEqual(recorder.get('trial.draws'), expected)
+			self.assertEqual(recorder.get('seed'), 91)
+			self.assertEqual(len(recorder.get('control_1.responses')), 4)
+	
+	def test_records_equal_for_any_number_of_workers(self):
+		self.assertEqual(untimed(self.run_trials(draw_trial, 1)), untimed(self.run_trials(draw_trial, 2)))
+		directory = tempfile.mkdtemp()
+		try:
+			params = os.path.join(directory, 'params.csv')
+			ut.write_file('\n'.join(['num_trials,2', 'user_attribute_spec, 5; 2; 3', 'msg_attribute_spec, 4; 2; 3',
+									 'num_users,160', 'num_test_messages,20']), params)
+			scenario = Scenario(params)
+			self.assertEqual(untimed(self.run_trials(scenario, 1, 2, 92)), untimed(self.run_trials(scenario, 2, 2, 92)))
+		finally:
+			shutil.rmtree(directory)
+	
+	def test_merge_keeps_trial_order(self):
+		recorder = su.ScenarioRecorder()
+		recorder.set('seed', 1)
+		for t in range(3):
+			recorder.merge({'trial.draws': [t, t + 10], 'seed': 2, 'trial.k': [t]})
+		self.assertEqual(recorder.get('trial.draws'), [0, 10, 1, 11, 2, 12])
+		self.assertEqual(recorder.get('trial.k'), [0, 1, 2])
+		self.assertEqual(recorder.get('seed'), 2)
+
+if __name__ == '__main__':
+	unittest.main()
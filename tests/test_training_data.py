@@ -0,0 +1,98 @@
+# --------------------------------------------------------------------------------------
+# About: Tests of the compact training data store in training_data.py.
+# --------------------------------------------------------------------------------------
+
+import unittest
+import shutil
+import tempfile
+import random as rd
+import numpy as np
+import util as ut
+from data_gen import DataGenerator
+from training_data import TrainingData
+from knn import KNNOptimizer
+from tests.helpers import random_rows, grouped
+
+class TrainingDataTest(unittest.TestCase):
+	def test_data_round_trips_list_of_tuples_view(self):
+		for (seed, pos_prob) in [(21, 0.3), (22, 0.0), (23, 1.0)]:
+			rows = random_rows(seed, 300, pos_prob = pos_prob)
+			op = KNNOptimizer()
+			op.set_data_rows(rows)
+			self.assertEqual(op.data, grouped(rows))
+			again = KNNOptimizer()
+			again.set_data_rows(reduce(lambda w, (u, pos, neg): w + map(lambda m: (u, m, 1), pos) + 
+									   map(lambda m: (u, m, 0), neg), op.data, []))
+			self.assertEqual(again.data, op.data)
+	
+	def test_entries_survive_save_and_load(self):
+		rows = random_rows(24, 300)
+		store = TrainingData()
+		store.set_rows(rows)
+		directory = tempfile.mkdtemp()
+		try:
+			store.save(directory)
+			loaded = TrainingData().load(directory)
+			self.assertEqual(loaded.entries(), grouped(rows))
+			self.assertEqual(loaded.decoded_users(), map(lambda (u, pos, neg): u, grouped(rows)))
+		finally:
+			shutil.rmtree(directory)
+
+class EncodedRowsTest(unittest.TestCase):
+	def setUp(self):
+		rd.seed(25)
+		np.random.seed(25)
+		self.b = DataGenerator()
+		self.b.add_random_user_attrs(4, 2, 3)
+		self.b.add_random_inter_attrs(3, 2, 4)
+		self.b.set_random_propensities(3, 1, 2, 1, 2, 0.2, 0.8)
+		self.blocks = list(self.b.gen_row_blocks(400, self.b.gen_random_inters(20), 70))
+	
+	def decoded(self, (user_codes, inter_codes, resps)):
+		return zip(self.b.decode_entities(user_codes, self.b.user_attrs), 
+				   self.b.decode_entities(inter_codes, self.b.inter_attrs), resps.tolist())
+	
+	def add_encoded(self, store, (user_codes, inter_codes, resps)):
+		levels = lambda attrs: map(lambda (name, levs): levs, attrs)
+		return store.add_encoded_rows(user_codes, inter_codes, resps, levels(self.b.user_attrs), levels(self.b.inter_attrs))
+	
+	def assert_same_store(self, a, b):
+		for name in TrainingData.array_names:
+			self.assertEqual(getattr(a, name).tolist(), getattr(b, name).tolist())
+			self.assertEqual(getattr(a, name).dtype, getattr(b, name).dtype)
+		self.assertEqual(a.user_encoder.levels, b.user_encoder.levels)
+		self.assertEqual(a.msg_encoder.levels, b.msg_encoder.levels)
+		self.assertEqual(a.entries(), b.entries())
+	
+	def test_fit_encode_codes_equals_fit_encode(self):
+		levels = map(lambda (name, levs): levs, self.b.user_attrs)
+		a, b = ut.LevelEncoder(), ut.LevelEncoder()
+		for block in self.blocks:
+			users = map(lambda (u, m, r): u, self.decoded(block))
+			self.assertEqual(a.fit_encode_codes(block[0], levels).tolist(), b.fit_encode(users).tolist())
+			self.assertEqual(a.levels, b.levels)
+	
+	def test_encoded_blocks_equal_added_rows(self):
+		encoded, rows = TrainingData(), TrainingData()
+		for block in self.blocks:
+			self.assertEqual(self.add_encoded(encoded, block), rows.add_rows(self.decoded(block)))
+			self.assert_same_store(encoded, rows)
+		whole = TrainingData()
+		whole.set_rows(reduce(lambda x, y: x + y, map(self.decoded, self.blocks)))
+		self.assert_same_store(encoded, whole)
+	
+	def test_encoded_blocks_added_to_loaded_store(self):
+		directory = tempfile.mkdtemp()
+		try:
+			store = TrainingData()
+			self.add_encoded(store, self.blocks[0])
+			store.save(directory)
+			loaded = TrainingData().load(directory)
+			for block in self.blocks[1:]:
+				self.assertEqual(self.add_encoded(loaded, block), store.add_rows(self.decoded(block)))
+			self.assert_same_store(loaded, store)
+		finally:
+			shutil.rmtree(directory)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,160 @@
+# --------------------------------------------------------------------------------------
+# About: Tests of the utility functions and classes in util.py, checked against the
+#        simple versions they replaced.
+# --------------------------------------------------------------------------------------
+
+import unittest
+import random as rd
+import numpy as np
+import util as ut
+from benchmarks import insertion_top_n as reference_top_n
+
+class TopNTest(unittest.TestCase):
+	def setUp(self):
+		gen = rd.Random(4)
+		self.lists = map(lambda size: map(lambda i: gen.randint(0, 5), range(size)), [0, 1, 2, 7, 30, 200])
+	
+	def test_top_n_ties_match_reference(self):
+		for values in self.lists:
+			items = list(enumerate(values))
+			for n in [0, 1, 3, 10, 300]:
+				self.assertEqual(ut.top_n(items, n, lambda (i, v): v), reference_top_n(items, n, lambda (i, v): v))
+	
+	def test_top_n_of_array_matches_reference(self):
+		for values in self.lists:
+			arr = np.array(values, dtype = np.int64)
+			for n in [1, 3, 10, 300]:
+				self.assertEqual(ut.top_n(arr, n), reference_top_n(values, n))
+				self.assertEqual(ut.top_n(arr, n, lambda v: -v), reference_top_n(values, n, lambda v: -v))
+				self.assertEqual(ut.top_n(np.arange(len(arr)), n, lambda i: values[i]), 
+								 reference_top_n(range(len(arr)), n, lambda i: values[i]))
+	
+	def test_top_n_indices_ties_in_index_order(self):
+		for values in self.lists:
+			items = list(enumerate(values))
+			for n in [0, 1, 3, 10, 300]:
+				expected = map(lambda (i, v): i, reference_top_n(items, n, lambda (i, v): v))
+				self.assertEqual(ut.top_n_indices(np.array(values), n).tolist(), expected)
+				self.assertEqual(ut.top_n_indices(np.array(values, dtype = np.uint8), n).tolist(), expected)
+				self.assertEqual(ut.top_n_indices(np.array(values, dtype = float) / 3, n).tolist(), expected)
+
+# The original recursive cartesian product, the last list varying fastest.
+def reference_cartesian_prod(list_of_lists):
+	if len(list_of_lists) == 1:
+		return map(lambda x: [x], list_of_lists[0])
+	rest = reference_cartesian_prod(list_of_lists[1:])
+	return reduce(lambda w, x: w + x, map(lambda y: map(lambda z: [y] + z, rest), list_of_lists[0]))
+
+class MixedRadixSpaceTest(unittest.TestCase):
+	def setUp(self):
+		self.cases = [[[1, 2, 3]], [['a', 'b'], [0, 1, 2], [True]], [[0, 1], ['x', 'y', 'z'], [2.5, 3.5], [4, 5, 6, 7]],
+					  [[(1, 2), (3, 4)], [[5], [6, 7]], [None, 'n']]]
+	
+	def test_combinations_equal_reference(self):
+		for lists in self.cases:
+			expected = reference_cartesian_prod(lists)
+			space = ut.MixedRadixSpace(lists)
+			self.assertEqual(len(space), len(expected))
+			self.assertEqual(list(space), expected)
+			self.assertEqual(ut.cartesian_prod(lists), expected)
+			self.assertEqual(map(lambda i: space[i], range(len(space))), expected)
+			self.assertEqual(map(lambda i: space[-i], range(1, len(space) + 1)), map(lambda i: expected[-i], range(1, len(expected) + 1)))
+			self.assertRaises(IndexError, lambda: space[len(space)])
+			self.assertRaises(IndexError, lambda: space[-len(space) - 1])
+	
+	def test_slices_and_chunks_equal_reference(self):
+		for lists in self.cases:
+			expected = reference_cartesian_prod(lists)
+			space = ut.MixedRadixSpace(lists)
+			for (start, stop, step) in [(None, None, None), (1, None, None), (None, -2, None), (2, 9, 3), (None, None, -1), (-3, 1, -2)]:
+				self.assertEqual(space[start:stop:step], expected[start:stop:step])
+			for chunk_size in [1, 4, len(expected), len(expected) + 5]:
+				chunks = list(space.chunks(chunk_size))
+				self.assertEqual(map(len, chunks), map(lambda start: len(expected[start:start + chunk_size]), range(0, len(expected), chunk_size)))
+				self.assertEqual(reduce(lambda w, x: w + x, chunks, []), expected)
+	
+	def test_codes_index_the_lists(self):
+		for lists in self.cases:
+			expected = reference_cartesian_prod(lists)
+			space = ut.MixedRadixSpace(lists)
+			codes = space.codes(np.arange(len(space)))
+			self.assertEqual(map(lambda row: map(lambda (items, c): items[c], zip(lists, row)), codes.tolist()), expected)
+			self.assertEqual(space.index_of(codes).tolist(), range(len(space)))
+			self.assertEqual(space.combinations([3 % len(space), 0, 3 % len(space)]), map(lambda i: expected[i], [3 % len(space), 0, 3 % len(space)]))
+
+class LevelEncoderTest(unittest.TestCase):
+	def test_decode_inverts_encode(self):
+		for rows in [[['a', 1], ['b', 2], ['a', 3]], [[(1, 2), 'x'], [(3, 4), 'y'], [(1, 2), 'y']],
+					 [[(1, 2), (5,)], [(1, 2), (5,)]], [[(1, 2, 3), None], [(4, 5, 6), 2.5]]]:
+			enc = ut.LevelEncoder()
+			codes = enc.fit_encode(rows)
+			self.assertEqual(enc.decode(codes), rows)
+			self.assertEqual(map(enc.decode_row, codes), rows)
+			self.assertEqual(ut.object_array(enc.levels[0]).shape, (len(enc.levels[0]),))
+
+class SplitTest(unittest.TestCase):
+	def setUp(self):
+		gen = rd.Random(23)
+		self.cases = map(lambda (n, levels): map(lambda i: gen.randint(0, levels - 1), range(n)), 
+						 [(0, 1), (1, 1), (7, 3), (40, 2), (101, 5), (500, 3)])
+		self.fracs = [(0.5, 0.25, 0.25), (0.6, 0.2), (1.0,), (0.3, 0.3, 0.3)]
+	
+	def test_review_example_sizes(self):
+		strata = [0, 0, 0, 1, 1, 2, 2]
+		self.assertEqual(map(len, ut.split_indices(7, (0.5, 0.25, 0.25), strata, 1)), [4, 2, 1])
+		self.assertEqual(map(len, ut.split_indices(7, (0.5, 0.25, 0.25), None, 1)), [4, 2, 1])
+	
+	def test_split_sizes_and_totals(self):
+		for strata in self.cases:
+			n = len(strata)
+			for fracs in self.fracs:
+				sizes = map(len, ut.split_indices(n, fracs, None, 3))
+				self.assertEqual(sizes, map(lambda i: min(n, sum(map(lambda f: int(np.ceil(f * n)), fracs[:i + 1]))) - 
+												   min(n, sum(map(lambda f: int(np.ceil(f * n)), fracs[:i]))), range(len(fracs))))
+				splits = ut.split_indices(n, fracs, strata, 3)
+				self.assertEqual(map(len, splits), sizes)
+				inds = reduce(lambda w, x: w + x, map(lambda inds: inds.tolist(), splits), [])
+				self.assertEqual(len(set(inds)), len(inds))
+				self.assertTrue(all(map(lambda i: 0 <= i < n, inds)))
+	
+	def test_strata_proportions(self):
+		for strata in self.cases:
+			n = len(strata)
+			for fracs in self.fracs:
+				for inds in ut.split_indices(n, fracs, strata, 5):
+					for level in set(strata):
+						quota = len(inds) * strata.count(level) / float(n)
+						self.assertTrue(abs(map(lambda i: strata[i], inds.tolist()).count(level) - quota) < 1)
+	
+	def test_seed_reproduces_splits(self):
+		for strata in [None, self.cases[-1]]:
+			a = ut.split_indices(500, (0.5, 0.25, 0.25), strata, 7)
+			b = ut.split_indices(500, (0.5, 0.25, 0.25), strata, 7)
+			self.assertEqual(map(lambda x: x.tolist(), a), map(lambda x: x.tolist(), b))
+			c = ut.split_indices(500, (0.5, 0.25, 0.25), strata, 8)
+			self.assertNotEqual(map(lambda x: x.tolist(), a), map(lambda x: x.tolist(), c))
+			np.random.seed(9)
+			a = ut.split_indices(500, (0.5, 0.25, 0.25), strata)
+			np.random.seed(9)
+			self.assertEqual(map(lambda x: x.tolist(), a), map(lambda x: x.tolist(), ut.split_indices(500, (0.5, 0.25, 0.25), strata)))
+	
+	def test_views_read_the_split_rows(self):
+		rows = map(lambda i: (i, 'r' + str(i), i % 3), range(50))
+		strata = map(lambda r: r[2], rows)
+		views = ut.split_views(rows, (0.5, 0.25, 0.25), strata, 11)
+		for (view, inds) in zip(views, ut.split_indices(len(rows), (0.5, 0.25, 0.25), strata, 11)):
+			expected = map(lambda i: rows[i], inds.tolist())
+			self.assertEqual(len(view), len(expected))
+			self.assertEqual(list(view), expected)
+			self.assertEqual(map(lambda i: view[i], range(len(view))), expected)
+			self.assertEqual(view[-1], expected[-1])
+			self.assertEqual(list(view[1:6:2]), expected[1:6:2])
+			self.assertTrue(view[1:6:2].rows is rows)
+			self.assertEqual(view.column(1), map(lambda r: r[1], expected))
+		np.random.seed(12)
+		copies = ut.split_data(rows, 0.5, 0.25, 0.25)
+		np.random.seed(12)
+		self.assertEqual(map(list, ut.split_views(rows, (0.5, 0.25, 0.25))), list(copies))
+
+if __name__ == '__main__':
+	unittest.main()
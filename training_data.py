@@ -0,0 +1,238 @@
+# --------------------------------------------------------------------------------------
+# About: This file provides compact, array-backed storage for the historical
+#        (user, message, response) data used by the nearest-neighbor optimizer.
+# --------------------------------------------------------------------------------------
+
+import os
+import cPickle
+import numpy as np
+import util as ut
+
+# This class holds (user, msg, response) data rows grouped by user as small integer
+# codes (see util.LevelEncoder), whose encoders are the level dictionaries for decoding.
+# Distinct users are the rows of self.users, in order of first appearance. The positive
+# messages of user i are rows pos_offsets[i] to pos_offsets[i + 1] of self.pos, in the
+# order they were added, and the negative messages are held the same way in self.neg.
+class TrainingData(object):
+	array_names = ['users', 'pos', 'neg', 'pos_offsets', 'neg_offsets'] # The arrays written by save
+	
+	def __init__(self):
+		self.user_encoder = ut.LevelEncoder()
+		self.msg_encoder = ut.LevelEncoder()
+		self.users = np.zeros((0, 0), dtype = np.int8)
+		self.pos = np.zeros((0, 0), dtype = np.int8)
+		self.neg = np.zeros((0, 0), dtype = np.int8)
+		self.pos_offsets = np.zeros(1, dtype = np.int64)
+		self.neg_offsets = np.zeros(1, dtype = np.int64)
+		self.rows_of = {} # Index in self.users of each user (in hashable form), or None until needed
+		self.decoded = None # The decoded users, built on first use
+	
+	def __len__(self):
+		return len(self.users)
+	
+	# Replace the data with the given (user, msg, response) rows.
+	def set_rows(self, data_rows):
+		self.__init__()
+		self.add_rows(data_rows)
+	
+	# Add (user, msg, response) rows. Messages of known users are added after their
+	# existing ones, and new users are appended in order of first appearance.
+	# Returns: (set of indices of previously known users which changed, number of previous users)
+	def add_rows(self, data_rows):
+		num_old = len(self.users)
+		owners = np.empty(len(data_rows), dtype = np.int64)
+		new_users = []
+		rows_of = self.user_rows()
+		for (n, (u, m, r)) in enumerate(data_rows):
+			key = ut.hashable(u)
+			i = rows_of.get(key)
+			if i == None:
+				i = num_old + len(new_users)
+				rows_of[key] = i
+				new_users.append(u)
+			owners[n] = i
+		if len(new_users) > 0:
+			new_codes = self.user_encoder.fit(new_users).encode(new_users)
+			self.users = np.vstack((self.users.reshape(num_old, new_codes.shape[1]).astype(new_codes.dtype), new_codes))
+		msgs = map(lambda (u, m, r): m, data_rows)
+		codes = self.msg_encoder.fit(msgs).encode(msgs)
+		positive = np.array(map(lambda (u, m, r): r == 1, data_rows), dtype = bool)
+		self.pos, self.pos_offsets = self.insert_messages(self.pos, self.pos_offsets, codes[positive], owners[positive])
+		self.neg, self.neg_offsets = self.insert_messages(self.neg, self.neg_offsets, codes[~positive], owners[~positive])
+		self.decoded = None
+		return (set(owners[owners < num_old].tolist()), num_old)
+	
+	# As add_rows, for rows given as arrays: the users and messages as matrices of indices
+	# into the given level lists (see LevelEncoder.fit_encode_codes), as DataGenerator's
+	# gen_row_blocks makes them, and the responses. Only the distinct users of the rows are
+	# decoded, to find them among the known users, so the store is filled block by block
+	# without the rows ever being held as lists. The store is as add_rows would make it.
+	def add_encoded_rows(self, user_codes, msg_codes, resps, user_levels, msg_levels):
+		num_old = len(self.users)
+		if len(resps) == 0:
+			return (set(), num_old)
+		codes = self.user_encoder.fit_encode_codes(user_codes, user_levels)
+		distinct, firsts, inverse = np.unique(codes, axis = 0, return_index = True, return_inverse = True)
+		order = np.argsort(firsts)
+		rank = np.empty(len(order), dtype = np.int64)
+		rank[order] = np.arange(len(order))
+		found = np.empty(len(order), dtype = np.int64)
+		new_users = []
+		rows_of = self.user_rows()
+		for (n, u) in enumerate(self.user_encoder.decode(distinct[order])):
+			key = ut.hashable(u)
+			i = rows_of.get(key)
+			if i == None:
+				i = num_old + len(new_users)
+				rows_of[key] = i
+				new_users.append(n)
+			found[n] = i
+		if len(new_users) > 0:
+			new_codes = distinct[order][new_users]
+			self.users = np.vstack((self.users.reshape(num_old, new_codes.shape[1]).astype(new_codes.dtype), new_codes))
+		owners = found[rank[inverse.ravel()]]
+		codes = self.msg_encoder.fit_encode_codes(msg_codes, msg_levels)
+		positive = np.asarray(resps) == 1
+		self.pos, self.pos_offsets = self.insert_messages(self.pos, self.pos_offsets, codes[positive], owners[positive])
+		self.neg, self.neg_offsets = self.insert_messages(self.neg, self.neg_offsets, codes[~positive], owners[~positive])
+		self.decoded = None
+		return (set(owners[owners < num_old].tolist()), num_old)
+	
+	# Insert encoded messages into a grouped message matrix, after the existing messages of
+	# their owners. Returns the new (message matrix, offsets).
+	def insert_messages(self, msgs, offsets, codes, owners):
+		order = np.argsort(owners, kind = 'mergesort')
+		codes, owners = codes[order], owners[order]
+		counts = np.zeros(len(self.users), dtype = np.int64)
+		counts[:len(offsets) - 1] = np.diff(offsets)
+		ends = np.append(offsets[1:], np.zeros(len(self.users) + 1 - len(offsets), dtype = np.int64) + offsets[-1])
+		msgs = msgs.reshape(len(msgs), codes.shape[1]).astype(self.msg_encoder.dtype())
+		msgs = np.insert(msgs, ends[owners], codes, axis = 0)
+		counts += np.bincount(owners, minlength = len(self.users))
+		return (msgs, np.concatenate(([0], np.cumsum(counts))))
+	
+	# Remove (user, msg, response) rows, taking out one matching message per row; raises
+	# a ValueError if there is none. Users left with no messages are removed, and the 
+	# remaining users keep their order.
+	# Returns: (set of indices of the users which changed, sorted list of removed user indices)
+	def retire_rows(self, data_rows):
+		touched = set()
+		drops = {True: [], False: []}
+		for (u, m, r) in data_rows:
+			i = self.user_rows().get(ut.hashable(u))
+			if i == None:
+				raise ValueError('No data rows for user: ' + str(u))
+			msgs, offsets = (self.pos, self.pos_offsets) if r == 1 else (self.neg, self.neg_offsets)
+			block = msgs[offsets[i]:offsets[i + 1]] == self.msg_encoder.encode_row(m)
+			rows = filter(lambda x: not(x in drops[r == 1]), (offsets[i] + np.flatnonzero(block.all(axis = 1))).tolist())
+			if len(rows) == 0:
+				raise ValueError('No data row for user ' + str(u) + ' with message ' + str(m))
+			drops[r == 1].append(rows[0])
+			touched.add(i)
+		self.pos, self.pos_offsets = self.delete_messages(self.pos, self.pos_offsets, drops[True])
+		self.neg, self.neg_offsets = self.delete_messages(self.neg, self.neg_offsets, drops[False])
+		removed = sorted(filter(lambda i: self.num_messages(i, True) + self.num_messages(i, False) == 0, touched))
+		if len(removed) > 0:
+			kept = np.ones(len(self.users), dtype = bool)
+			kept[removed] = False
+			self.users = self.users[kept]
+			self.pos_offsets = np.append(self.pos_offsets[:-1][kept], self.pos_offsets[-1])
+			self.neg_offsets = np.append(self.neg_offsets[:-1][kept], self.neg_offsets[-1])
+			gone = set(removed)
+			self.rows_of = dict(map(lambda (key, i): (key, i - int(np.searchsorted(removed, i))), 
+									filter(lambda (key, i): not(i in gone), self.rows_of.items())))
+		self.decoded = None
+		return (touched, removed)
+	
+	# Delete the given rows from a grouped message matrix. Returns the new (message matrix, offsets).
+	def delete_messages(self, msgs, offsets, rows):
+		if len(rows) == 0:
+			return (msgs, offsets)
+		rows = np.sort(rows)
+		return (np.delete(msgs, rows, axis = 0), offsets - np.searchsorted(rows, offsets))
+	
+	# The index in self.users of each user (in hashable form). After a load this is
+	# built on first use, so a loaded store which is only queried never decodes its users.
+	def user_rows(self):
+		if self.rows_of == None:
+			self.rows_of = dict(zip(map(ut.hashable, self.decoded_users()), range(len(self.users))))
+		return self.rows_of
+	
+	# The number of positive (or negative) messages of user i.
+	def num_messages(self, i, positive):
+		offsets = self.pos_offsets if positive else self.neg_offsets
+		return offsets[i + 1] - offsets[i]
+	
+	# The decoded user i.
+	def user(self, i):
+		return self.user_encoder.decode_row(self.users[i])
+	
+	# All decoded users, in order. Kept until the data changes.
+	def decoded_users(self):
+		if self.decoded == None:
+			self.decoded = self.user_encoder.decode(self.users)
+		return self.decoded
+	
+	# The decoded positive (or negative) messages of user i.
+	def messages(self, i, positive):
+		msgs, offsets = (self.pos, self.pos_offsets) if positive else (self.neg, self.neg_offsets)
+		return self.msg_encoder.decode(msgs[offsets[i]:offsets[i + 1]])
+	
+	# Returns (rows, owners) for the positive (or negative) messages of the users at the
+	# given indices: the rows of self.pos (or self.neg) holding them, grouped by user in
+	# the order of inds, and for each row the position in inds of the user it belongs to.
+	def message_rows(self, inds, positive):
+		offsets = self.pos_offsets if positive else self.neg_offsets
+		inds = np.asarray(inds, dtype = np.int64)
+		starts = offsets[inds]
+		counts = offsets[inds + 1] - starts
+		firsts = np.cumsum(counts) - counts
+		rows = np.arange(counts.sum()) + np.repeat(starts - firsts, counts)
+		return (rows, np.repeat(np.arange(len(inds)), counts))
+	
+	# Returns a store holding users lo to hi - 1 of this one with their messages, sharing 
+	# its encoders. Its arrays are slices of this store's where possible, so the shard
+	# of a memory mapped store only reads its own part of the files.
+	def shard(self, lo, hi):
+		sub = TrainingData()
+		sub.user_encoder, sub.msg_encoder = self.user_encoder, self.msg_encoder
+		sub.users = self.users[lo:hi]
+		sub.pos = self.pos[self.pos_offsets[lo]:self.pos_offsets[hi]]
+		sub.neg = self.neg[self.neg_offsets[lo]:self.neg_offsets[hi]]
+		sub.pos_offsets = self.pos_offsets[lo:hi + 1] - self.pos_offsets[lo]
+		sub.neg_offsets = self.neg_offsets[lo:hi + 1] - self.neg_offsets[lo]
+		sub.rows_of = None
+		return sub
+	
+	# The data as a list of (user, [pos msgs], [neg msgs]) tuples, decoded.
+	def entries(self):
+		return map(lambda i: (self.user(i), self.messages(i, True), self.messages(i, False)), range(len(self)))
+	
+	# Save the store into the given directory (created if needed): each array as a
+	# .npy file, and the level dictionaries of the encoders in levels.pkl.
+	def save(self, directory):
+		if not(os.path.isdir(directory)):
+			os.makedirs(directory)
+		for name in self.array_names:
+			np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+		f = open(os.path.join(directory, 'levels.pkl'), 'wb')
+		cPickle.dump((self.user_encoder.levels, self.msg_encoder.levels), f, 2)
+		f.close()
+	
+	# Load a store saved into the given directory, replacing this one. By default the
+	# arrays are memory mapped read-only (see numpy.load), so loading costs the same 
+	# whatever the data size and processes loading the same files share their pages. 
+	# Adding or retiring rows later works on copies and leaves the files unchanged.
+	def load(self, directory, mmap_mode = 'r'):
+		self.__init__()
+		for name in self.array_names:
+			setattr(self, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode = mmap_mode))
+		f = open(os.path.join(directory, 'levels.pkl'), 'rb')
+		user_levels, msg_levels = cPickle.load(f)
+		f.close()
+		self.user_encoder.levels = user_levels
+		self.user_encoder.codes = map(lambda levs: dict(zip(levs, range(len(levs)))), user_levels)
+		self.msg_encoder.levels = msg_levels
+		self.msg_encoder.codes = map(lambda levs: dict(zip(levs, range(len(levs)))), msg_levels)
+		self.rows_of = None
+		return self
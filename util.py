@@ -6,8 +6,11 @@
 
 import calendar
 import time
-import random as rd
 import math
+import heapq
+import sys
+import numpy as np
+from collections import OrderedDict
 
 # Build a dict list representation from user and interaction attribute lists.
 def dict_list_representation(user_atts, inter_atts):
@@ -20,24 +23,33 @@ def dict_list_representation(user_atts, inter_atts):
 		dlrep.append(dict(zip(headings, row)))
 	return dlrep
 
-# Get the top n items in ascending order.
+# Get the top n items, highest first. The comparison metric is computed once per
+# item. Ties are broken deterministically: of items with equal metrics, the one 
+# appearing earlier in items comes first, and is the one kept at the cutoff.
+# The items go through a heap. For the top values of a numpy array, see top_n_indices.
 # Param items: the items
 # Param n: the number of top items to return
 # Param accessor_f: a function to access the comparison metric from each item.
 def top_n(items, n, accessor_f = lambda x: x):
-	top = []
-	for item in items:
-		if len(top) == 0 and n > 0:
-			top.append(item)
-		else:
-			i = 0
-			while i < len(top) and accessor_f(item) > accessor_f(top[i]):
-				i += 1
-			top.insert(i, item)
-			if len(top) > n:
-				del(top[0])
-	top.reverse()
-	return top
+	return heapq.nlargest(n, items, key = accessor_f)
+
+# Get the indices of the top n values of a 1-D numpy array, highest value first,
+# with the same tie-breaking as top_n (equal values in ascending index order).
+# Runs in linear time plus a sort of the n selected values.
+def top_n_indices(values, n):
+	values = np.asarray(values)
+	if values.dtype.kind in 'bu':
+		values = values.astype(np.int64)
+	if n <= 0:
+		return np.zeros(0, dtype = np.int64)
+	if n < len(values):
+		cutoff = np.partition(values, len(values) - n)[len(values) - n]
+		above = np.flatnonzero(values > cutoff)
+		tied = np.flatnonzero(values == cutoff)[:n - len(above)]
+		inds = np.concatenate((above, tied))
+	else:
+		inds = np.arange(len(values))
+	return inds[np.argsort(-values[inds], kind = 'mergesort')]
 	
 # For a given pattern and list of patterns, return the closest partial match from the list.	
 # Param ifzeromatches: what to return if no partial matches.
@@ -54,6 +66,15 @@ def best_match(pat, pat_list, ifzeromatches=None,
 	return top_n(ms, 1, lambda x:x[1])[0][0]
 	
 	
+# For a matrix of codes (as from LevelEncoder.encode) and a number per row, returns a
+# numpy array holding for each row the total of the numbers of all rows equal to it.
+def row_totals(codes, values):
+	values = np.asarray(values, dtype = np.int64)
+	if len(codes) == 0 or codes.shape[1] == 0:
+		return np.zeros(len(values), dtype = np.int64) + values.sum()
+	ucodes, inverse = np.unique(codes, axis = 0, return_inverse = True)
+	return np.bincount(inverse, weights = values).astype(np.int64)[inverse]
+
 # Get the current time in seconds since the epoch.	
 def curr_time():
 	return calendar.timegm(time.gmtime())
@@ -76,30 +97,171 @@ def cumulative_bin_search(val, items):
 		return min_ind
 	return max_ind
 
-# For row-based data, split into random specified fractions.
+# For row-based data, split into random specified fractions (see split_indices).
+# Returns a tuple of lists of rows; split_views splits without copying the rows.
 def split_data(rows, *fracs):
-	total = len(rows)
-	curr_rows = list(rows)
-	splits = []
+	rows = list(rows)
+	return tuple(map(lambda inds: map(lambda i: rows[i], inds.tolist()), split_indices(len(rows), fracs)))
+
+# Splits the indices of n rows into random specified fractions from one permutation:
+# split i takes ceil(fracs[i] * n) of the indices (or as many as are left), in random 
+# order. If strata (one value per row, e.g. the responses) is given, the splits keep
+# these sizes and each one's rows are shared among the strata in proportion to their
+# sizes (see largest_remainder), so the splits keep the strata's proportions. The draws 
+# come from a numpy RandomState with the given seed, or the global numpy generator if 
+# seed is None. Returns a tuple of numpy index arrays.
+def split_indices(n, fracs, strata = None, seed = None):
+	rs = np.random.RandomState(seed) if seed != None else np.random
+	perm = rs.permutation(n)
+	bounds = [0]
 	for f in fracs:
-		rand_inds = rd.sample(range(len(curr_rows)), min(int(math.ceil(f * total)), len(curr_rows)))
-		rem_inds = filter(lambda i: not(i in rand_inds), range(len(curr_rows)))
-		splits.append(map(lambda i: curr_rows[i], rand_inds))
-		curr_rows = map(lambda i: curr_rows[i], rem_inds)
+		bounds.append(min(bounds[-1] + int(math.ceil(f * n)), n))
+	if strata is None:
+		return tuple(map(lambda (start, end): perm[start:end], zip(bounds[:-1], bounds[1:])))
+	vals = np.asarray(strata)[perm]
+	order = np.argsort(vals, kind = 'mergesort')
+	starts = np.flatnonzero(np.r_[True, vals[order][1:] != vals[order][:-1]]) if n > 0 else []
+	groups = np.split(perm[order], starts[1:]) if n > 0 else []
+	sizes = np.array(map(len, groups), dtype = np.int64)
+	taken = np.zeros(len(groups), dtype = np.int64)
+	position = np.empty(n, dtype = np.int64)
+	position[perm] = np.arange(n)
+	splits = []
+	for (start, end) in zip(bounds[:-1], bounds[1:]):
+		counts = largest_remainder(end - start, (end - start) * sizes / float(max(n, 1)), sizes - taken)
+		inds = np.concatenate([np.zeros(0, dtype = np.int64)] + 
+							  map(lambda (g, t, c): g[t:t + c], zip(groups, taken.tolist(), counts.tolist())))
+		splits.append(inds[np.argsort(position[inds], kind = 'mergesort')])
+		taken += counts
 	return tuple(splits)
+
+# Shares total whole items among parties with the given (fractional) quotas, each party
+# taking at most its cap: each gets the whole part of its quota, and the items left go
+# one at a time to the parties with the largest remainders (the earlier one on ties), 
+# skipping those at their caps. The caps must sum to at least total. Returns the counts.
+def largest_remainder(total, quotas, caps):
+	counts = np.minimum(np.floor(quotas).astype(np.int64), caps)
+	order = np.argsort(counts - quotas, kind = 'mergesort').tolist()
+	while counts.sum() < total:
+		for j in order:
+			if counts.sum() < total and counts[j] < caps[j]:
+				counts[j] += 1
+	return counts
+
+# Splits rows into random specified fractions as by split_indices, returning a tuple of
+# SplitViews over the rows rather than copies.
+def split_views(rows, fracs, strata = None, seed = None):
+	return tuple(map(lambda inds: SplitView(rows, inds), split_indices(len(rows), fracs, strata, seed)))
+
+# This class is a read-only, list-like view of the rows at an array of indices into 
+# shared rows (see split_views). Slicing a view gives another view over the same rows.
+class SplitView(object):
+	def __init__(self, rows, inds):
+		self.rows = rows
+		self.inds = np.asarray(inds, dtype = np.int64)
+	
+	def __len__(self):
+		return len(self.inds)
 	
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return SplitView(self.rows, self.inds[i])
+		return self.rows[self.inds[i]]
 	
+	def __iter__(self):
+		rows = self.rows
+		for i in self.inds.tolist():
+			yield rows[i]
+	
+	# The j-th item of each row in the view, as a list.
+	def column(self, j):
+		rows = self.rows
+		return map(lambda i: rows[i][j], self.inds.tolist())
+
+# For data streamed as blocks of rows, each block a tuple of numpy arrays with one row
+# per element (e.g. as from DataGenerator.gen_row_blocks), route the rows into splits as
+# they go by: each row goes to split i with probability fracs[i], and rows beyond the
+# fractions' sum are dropped. Yields (split index, block of the split's rows) pairs, so
+# only one block is held at a time.
+def split_blocks(blocks, *fracs):
+	bounds = np.cumsum(fracs)
+	for block in blocks:
+		which = np.searchsorted(bounds, np.random.uniform(0, 1, len(block[0])), side = 'right')
+		for i in range(len(fracs)):
+			mask = which == i
+			yield (i, tuple(map(lambda arr: arr[mask], block)))
+
 # Return the distinct objects in a list.
 def distinct(items):
 	s = list(set(map(lambda x: str(x), items)))
 	return map(lambda x: eval(x), s)
 
-# For a list of lists, 	
+# For a list of lists, return the list of every combination taking one item from each 
+# list, the last list varying fastest. MixedRadixSpace enumerates them lazily.
 def cartesian_prod(list_of_lists):
-	if len(list_of_lists) == 1:
-		return map(lambda x: [x], list_of_lists[0])
-	rest = cartesian_prod(list_of_lists[1:])
-	return reduce(lambda w, x: w + x, map(lambda y: map(lambda z: [y] + z, rest), list_of_lists[0]))
+	return list(MixedRadixSpace(list_of_lists))
+
+# This class is a lazy, read-only list of the combinations of a cartesian product of 
+# lists, in the order of cartesian_prod. Combination i is found in constant time by 
+# reading i as a mixed-radix number whose digits index the lists (the last list's digit
+# being the lowest), so combinations are only made when asked for. Slices and chunks 
+# of combinations are made in bulk with numpy.
+class MixedRadixSpace(object):
+	def __init__(self, list_of_lists):
+		self.lists = map(list, list_of_lists)
+		self.radices = np.array(map(len, self.lists), dtype = np.int64)
+		self.strides = np.array(map(lambda j: reduce(lambda w, x: w * x, self.radices[j + 1:].tolist(), 1), 
+									range(len(self.lists))), dtype = np.int64)
+		self.size = reduce(lambda w, x: w * x, self.radices.tolist(), 1)
+		self.levels = map(object_array, self.lists)
+	
+	def __len__(self):
+		return self.size
+	
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return self.combinations(np.arange(*i.indices(self.size)))
+		if i < 0:
+			i += self.size
+		if i < 0 or i >= self.size:
+			raise IndexError('combination index out of range')
+		return map(lambda (items, stride, radix): items[(i // stride) % radix], 
+				   zip(self.lists, self.strides.tolist(), self.radices.tolist()))
+	
+	def __iter__(self):
+		for chunk in self.chunks():
+			for combination in chunk:
+				yield combination
+	
+	# Returns a (len(inds) X number of lists) numpy array of the digits of the combinations
+	# at the given indices: digit j is the index of the combination's item in list j.
+	def codes(self, inds):
+		inds = np.asarray(inds, dtype = np.int64).reshape(-1, 1)
+		return (inds // self.strides) % self.radices
+	
+	# Returns a numpy array of the indices of combinations given by their digits (as by 
+	# codes), one combination per row.
+	def index_of(self, codes):
+		return np.asarray(codes, dtype = np.int64).dot(self.strides)
+	
+	# Returns the list of combinations at the given indices.
+	def combinations(self, inds):
+		codes = self.codes(inds)
+		cols = map(lambda (j, levels): levels[codes[:, j]].tolist(), enumerate(self.levels))
+		return map(list, zip(*cols)) if len(cols) > 0 else map(lambda i: [], range(len(codes)))
+	
+	# Yields the combinations in order, in lists of at most chunk_size combinations.
+	def chunks(self, chunk_size = 10000):
+		for start in xrange(0, self.size, chunk_size):
+			yield self.combinations(np.arange(start, min(start + chunk_size, self.size)))
+
+# A numpy object array holding the items of a list as they are, even if they are
+# themselves tuples or lists (which numpy.array would turn into more dimensions).
+def object_array(items):
+	arr = np.empty(len(items), dtype = object)
+	for (i, item) in enumerate(items):
+		arr[i] = item
+	return arr
 
 # For a list of tuples, reverses
 def unzip(tuples):
@@ -205,5 +367,219 @@ class Cache(object):
 		
 	def values(self):
 		return self.h.values()
+
+# Convert a key to a hashable form: lists, tuples, and numpy arrays become 
+# tuples (nested ones included), anything else is kept as is.
+def hashable(key):
+	if isinstance(key, np.ndarray):
+		key = key.tolist()
+	if isinstance(key, (list, tuple)):
+		try:
+			t = tuple(key)
+			hash(t)
+			return t
+		except TypeError:
+			return tuple(map(hashable, key))
+	return key
+
+# A rough estimate of the memory held by an object, in bytes: numpy arrays count
+# their buffers, and containers and objects with attributes count their contents.
+def approx_size(obj):
+	if isinstance(obj, np.ndarray):
+		return obj.nbytes + sys.getsizeof(obj) if obj.base is None else sys.getsizeof(obj)
+	size = sys.getsizeof(obj)
+	if isinstance(obj, dict):
+		return size + sum(map(lambda (k, v): approx_size(k) + approx_size(v), obj.items()))
+	if isinstance(obj, (list, tuple, set)):
+		return size + sum(map(approx_size, obj))
+	if hasattr(obj, '__dict__'):
+		return size + approx_size(obj.__dict__)
+	return size
 		
-		
\ No newline at end of file
+# This class is a dict-like cache which, like Cache, allows using arbitrary
+# objects (like lists) as keys, but converts them to tuples (see hashable) 
+# rather than strings. It may be bounded by a number of entries and/or an
+# estimated number of bytes (see approx_size), evicting the least recently
+# used entries first, and it counts hits, misses, and evictions.
+class LRUCache(object):
+	def __init__(self, max_entries = None, max_bytes = None, sizeof_f = approx_size):
+		self.h = OrderedDict() # Least recently used first
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.sizeof_f = sizeof_f
+		self.sizes = {}
+		self.num_bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+	
+	def __setitem__(self, key, val):
+		key = hashable(key)
+		if self.h.has_key(key):
+			self.discard(key)
+		self.h[key] = val
+		if self.max_bytes != None:
+			self.sizes[key] = self.sizeof_f(val)
+			self.num_bytes += self.sizes[key]
+		self.evict()
+	
+	def __getitem__(self, key):
+		key = hashable(key)
+		val = self.h.pop(key)
+		self.h[key] = val
+		return val
+	
+	def __delitem__(self, key):
+		self.discard(hashable(key))
+	
+	def __contains__(self, key):
+		return self.h.has_key(hashable(key))
+	
+	def __len__(self):
+		return len(self.h)
+	
+	# Measure the size of the key's value again, after it has grown (or shrunk) in place,
+	# and evict least recently used entries if the cache is now over its bytes. Does 
+	# nothing if the key is not cached or the cache is not bounded by bytes.
+	def resize(self, key):
+		key = hashable(key)
+		if self.max_bytes == None or not(self.h.has_key(key)):
+			return
+		size = self.sizeof_f(self.h[key])
+		self.num_bytes += size - self.sizes[key]
+		self.sizes[key] = size
+		self.evict()
+	
+	# Evict least recently used entries until the cache is within its bounds.
+	def evict(self):
+		while len(self.h) > 0 and ((self.max_entries != None and len(self.h) > self.max_entries) or 
+								   (self.max_bytes != None and self.num_bytes > self.max_bytes)):
+			self.discard(next(iter(self.h)))
+			self.evictions += 1
+	
+	# Remove a (hashable) key and its size.
+	def discard(self, key):
+		del(self.h[key])
+		if self.sizes.has_key(key):
+			self.num_bytes -= self.sizes.pop(key)
+	
+	# Get the value for the key (marking it most recently used), or
+	# default if there is none. Counts a hit or a miss.
+	def get(self, key, default = None):
+		key = hashable(key)
+		if not(self.h.has_key(key)):
+			self.misses += 1
+			return default
+		self.hits += 1
+		val = self.h.pop(key)
+		self.h[key] = val
+		return val
+	
+	# Check for the key. Counts a hit or a miss.
+	def has_key(self, key):
+		if self.h.has_key(hashable(key)):
+			self.hits += 1
+			return True
+		self.misses += 1
+		return False
+	
+	def items(self):
+		return self.h.items()
+	
+	def keys(self):
+		return self.h.keys()
+	
+	def values(self):
+		return self.h.values()
+	
+	def clear(self):
+		self.h = OrderedDict()
+		self.sizes = {}
+		self.num_bytes = 0
+	
+	# Returns a dict of the cache's counters and current size.
+	def stats(self):
+		return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+				'entries': len(self.h), 'bytes': self.num_bytes if self.max_bytes != None else None}
+	
+# This class maps the attribute values at each position of a row (e.g. 'L_1', 
+# 'L_2', ...) to small integer codes, so that a list of rows can be held as a 
+# compact integer matrix. Values which were never fitted are encoded as -1,
+# which never matches a fitted code.
+class LevelEncoder(object):
+	def __init__(self):
+		self.levels = [] # levels[i] is the list of values at position i; a code is a list index
+		self.codes = [] # codes[i] is a dict of form {value: code} for position i
+	
+	# Add any unseen values in the rows to the level lists.
+	def fit(self, rows):
+		for row in rows:
+			if len(self.levels) < len(row):
+				for i in range(len(self.levels), len(row)):
+					self.levels.append([])
+					self.codes.append({})
+			for i in range(len(row)):
+				if not(self.codes[i].has_key(row[i])):
+					self.codes[i][row[i]] = len(self.levels[i])
+					self.levels[i].append(row[i])
+		return self
+	
+	# The number of attribute positions.
+	def width(self):
+		return len(self.levels)
+	
+	# The smallest signed integer type able to hold every code.
+	def dtype(self):
+		most = max(map(len, self.levels)) if len(self.levels) > 0 else 0
+		for t in [np.int8, np.int16, np.int32]:
+			if most <= np.iinfo(t).max:
+				return t
+		return np.int64
+	
+	# Encode a list of rows into an integer matrix of shape (rows, positions).
+	def encode(self, rows):
+		mat = np.empty((len(rows), self.width()), dtype = self.dtype())
+		for i in range(self.width()):
+			h = self.codes[i]
+			mat[:, i] = np.fromiter((h.get(row[i], -1) for row in rows), mat.dtype, len(rows))
+		return mat
+	
+	# Encode a single row into a 1-D integer array.
+	def encode_row(self, row):
+		return np.array(map(lambda (h, v): h.get(v, -1), zip(self.codes, row)), dtype = self.dtype())
+	
+	# Fit the rows, then encode them.
+	def fit_encode(self, rows):
+		return self.fit(rows).encode(rows)
+	
+	# As fit_encode, for rows given as a matrix of indices into other level lists (the
+	# code c at position i standing for levels[i][c]). Only the distinct codes of each
+	# position are looked up, so the rows are never decoded. Unseen values are added in
+	# order of first appearance, as fit would add them from the decoded rows.
+	def fit_encode_codes(self, codes, levels):
+		for i in range(len(self.levels), len(levels)):
+			self.levels.append([])
+			self.codes.append({})
+		translations = []
+		for i in range(len(levels)):
+			ucodes, firsts = np.unique(codes[:, i], return_index = True)
+			for c in ucodes[np.argsort(firsts)].tolist():
+				if not(self.codes[i].has_key(levels[i][c])):
+					self.codes[i][levels[i][c]] = len(self.levels[i])
+					self.levels[i].append(levels[i][c])
+			table = np.zeros(len(levels[i]), dtype = np.int64)
+			table[ucodes] = map(lambda c: self.codes[i][levels[i][c]], ucodes.tolist())
+			translations.append(table)
+		mat = np.empty((len(codes), len(levels)), dtype = self.dtype())
+		for i in range(len(levels)):
+			mat[:, i] = translations[i][codes[:, i]]
+		return mat
+	
+	# Decode an array of codes back into a list of attribute values.
+	def decode_row(self, codes):
+		return map(lambda (levs, c): levs[c], zip(self.levels, codes))
+	
+	# Decode an integer matrix of shape (rows, positions) back into a list of rows.
+	def decode(self, mat):
+		cols = map(lambda (levs, col): object_array(levs)[col], zip(self.levels, mat.T))
+		return map(list, zip(*cols)) if len(cols) > 0 else map(lambda r: [], range(len(mat)))